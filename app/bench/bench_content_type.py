@@ -0,0 +1,44 @@
+"""
+Measures the per request cost of resolving content types and extensions in main.py.
+
+Run from the app directory, with the App Engine SDK on the path:
+python bench/bench_content_type.py [app directory]
+
+Pass the app directory of an older revision to compare against it.
+"""
+import os
+import re
+import sys
+import timeit
+
+appPath = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[0:0] = [appPath, os.path.join(appPath, 'lib')]
+
+import main as contentServer
+
+ITERATIONS = 2000
+FILENAMES = [
+	"/labo-cdn.appspot.com/index.html",
+	"/labo-cdn.appspot.com/css/style.CSS",
+	"/labo-cdn.appspot.com/img/logo.png",
+	"/labo-cdn.appspot.com/files/archive.tar.gz",
+	"/labo-cdn.appspot.com/files/unknown.xyz",
+]
+
+def hasExtension(filename):
+	pattern = getattr(contentServer, 'HAS_EXTENSION_PATTERN', None)
+	if pattern is None:
+		# Older revisions compiled the pattern on every request.
+		pattern = re.compile("^.+\.([a-zA-Z0-9])*$")
+	return pattern.match(filename)
+
+def perCall(function):
+	seconds = timeit.timeit(lambda: [function(filename) for filename in FILENAMES], number=ITERATIONS)
+	return seconds / (ITERATIONS * len(FILENAMES)) * 1e6
+
+def main():
+	print "getContentType:  %8.1f us per call" % perCall(contentServer.getContentType)
+	print "extension check: %8.1f us per call" % perCall(hasExtension)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,87 @@
+"""
+Measures ReadBuffer reads of a large object against a fake storage backend.
+
+Run from the app directory, with the App Engine SDK on the path:
+python bench/bench_read_buffer.py [lib directory]
+
+Every GET takes LATENCY seconds plus its size at BANDWIDTH bytes per second, on
+the ndb event loop, so concurrent segment requests overlap. Pass the lib directory
+of an older revision to compare against it.
+"""
+import os
+import random
+import re
+import sys
+import time
+
+libPath = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib')
+sys.path.insert(0, libPath)
+
+from google.appengine.ext import ndb
+from cloudstorage import storage_api
+
+LATENCY = 0.03
+# Per request
+BANDWIDTH = 40e6
+OBJECT_SIZE = 64 * 1024 * 1024
+RANDOM_READS = 50
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-(\d+)")
+
+class FakeStorageApi(object):
+	def __init__(self, content):
+		self.content = content
+		self.requests = 0
+
+	def head_object(self, path, headers=None):
+		self.requests += 1
+		time.sleep(LATENCY)
+		return (200, self.headers(), '')
+
+	@ndb.tasklet
+	def get_object_async(self, path, headers=None):
+		self.requests += 1
+		(first, last) = [int(value) for value in RANGE_PATTERN.match(headers['Range']).groups()]
+		chunk = self.content[first:last + 1]
+		yield ndb.sleep(LATENCY + len(chunk) / BANDWIDTH)
+
+		headers = self.headers()
+		headers['content-range'] = "bytes %d-%d/%d" % (first, first + len(chunk) - 1, len(self.content))
+		raise ndb.Return((206, headers, chunk))
+
+	def headers(self):
+		return {'etag': '"etag"', 'x-goog-stored-content-length': str(len(self.content))}
+
+def readSequentially(content, chunkSize):
+	api = FakeStorageApi(content)
+	start = time.time()
+	readBuffer = storage_api.ReadBuffer(api, '/bucket/object')
+	total = 0
+	chunk = readBuffer.read(chunkSize)
+	while chunk:
+		total += len(chunk)
+		chunk = readBuffer.read(chunkSize)
+	assert total == len(content)
+	return (time.time() - start, api.requests)
+
+def readRandomly(content, chunkSize):
+	api = FakeStorageApi(content)
+	start = time.time()
+	readBuffer = storage_api.ReadBuffer(api, '/bucket/object')
+	generator = random.Random(3)
+	for _ in range(RANDOM_READS):
+		readBuffer.seek(generator.randrange(len(content) - chunkSize))
+		readBuffer.read(chunkSize)
+	return (time.time() - start, api.requests)
+
+def main():
+	content = 'x' * OBJECT_SIZE
+	for chunkSize in (1024 * 1024, 64 * 1024):
+		(elapsed, requests) = readSequentially(content, chunkSize)
+		print "sequential %4d KiB reads: %.2fs, %5.1f MB/s, %d requests" % (
+			chunkSize // 1024, elapsed, len(content) / elapsed / 1e6, requests)
+
+	(elapsed, requests) = readRandomly(content, 64 * 1024)
+	print "%d random 64 KiB reads:  %.2fs, %d requests" % (RANDOM_READS, elapsed, requests)
+
+if __name__ == '__main__':
+	main()
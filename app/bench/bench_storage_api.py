@@ -0,0 +1,71 @@
+"""
+Measures the per request cost of getting a storage API instance and its token.
+
+Run from the app directory, with the App Engine SDK on the path:
+python bench/bench_storage_api.py [lib directory]
+
+Every request gets a new request id, like on a live instance. The token storage
+is looked up through the memcache and app identity stubs, each lookup additionally
+waits TOKEN_LOOKUP_LATENCY seconds like a memcache round trip. Pass the lib
+directory of an older revision to compare against it.
+"""
+import os
+import sys
+import time
+
+libPath = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib')
+sys.path.insert(0, libPath)
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from cloudstorage import rest_api
+from cloudstorage import storage_api
+
+REQUESTS = 2000
+TOKEN_LOOKUP_LATENCY = 0.001
+
+class TokenLookups(object):
+	"""
+	Counts and delays the token storage lookups.
+	"""
+	def __init__(self, getById):
+		self.getById = getById
+		self.count = 0
+
+	@ndb.tasklet
+	def __call__(self, *args, **kwargs):
+		self.count += 1
+		yield ndb.sleep(TOKEN_LOOKUP_LATENCY)
+		result = yield self.getById(*args, **kwargs)
+		raise ndb.Return(result)
+
+def perRequest(function):
+	start = time.time()
+	for requestId in range(REQUESTS):
+		os.environ['REQUEST_LOG_ID'] = str(requestId)
+		function()
+	return (time.time() - start) / REQUESTS * 1e6
+
+def main():
+	bed = testbed.Testbed()
+	bed.activate()
+	bed.init_memcache_stub()
+	bed.init_datastore_v3_stub()
+	bed.init_app_identity_stub()
+	# Every lookup goes to memcache, like the first one of each live request.
+	ndb.get_context().set_cache_policy(False)
+
+	lookups = TokenLookups(rest_api._AE_TokenStorage_.get_by_id_async)
+	rest_api._AE_TokenStorage_.get_by_id_async = staticmethod(lookups)
+	try:
+		setup = perRequest(lambda: storage_api._get_storage_api(None))
+		withToken = perRequest(lambda: storage_api._get_storage_api(None).get_token_async().get_result())
+	finally:
+		bed.deactivate()
+
+	print "setup:         %8.1f us per request" % setup
+	print "setup + token: %8.1f us per request, %d token lookups for %d requests" % (
+		withToken, lookups.count, REQUESTS)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,169 @@
+import collections
+import threading
+import time
+
+class CacheEntry(object):
+	__slots__ = ('content', 'fileStat', 'validated')
+
+	def __init__(self, content, fileStat, validated):
+		self.content = content
+		self.fileStat = fileStat
+		self.validated = validated
+
+	def matches(self, fileStat):
+		return self.fileStat.etag == fileStat.etag and self.fileStat.generation == fileStat.generation
+
+class ObjectCache(object):
+	"""
+	Instance-local LRU cache of object contents, keyed by object path.
+
+	The cache is bounded by the total size of the cached contents, the least recently
+	used objects are evicted first. Every entry remembers the stat of the object it
+	was read at, its etag and generation identify the contents. It is served without
+	touching storage for `ttl` seconds after it was last validated, afterwards the
+	caller has to revalidate it against a stat.
+	"""
+	def __init__(self, maxBytes, maxObjectBytes, ttl):
+		assert maxObjectBytes <= maxBytes, 'An object may not exceed the cache size!'
+		self.maxBytes = maxBytes
+		self.maxObjectBytes = maxObjectBytes
+		self.ttl = ttl
+
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.size = 0
+		self.counters = collections.Counter()
+
+	def get(self, filename):
+		"""
+		Returns the entry for filename, or None. A returned entry is not necessarily fresh.
+		"""
+		with self.lock:
+			entry = self.entries.pop(filename, None)
+			if entry is None:
+				self.counters['misses'] += 1
+				return None
+
+			# Most recently used entries live at the end.
+			self.entries[filename] = entry
+			return entry
+
+	def isFresh(self, entry):
+		fresh = time.time() - entry.validated < self.ttl
+		if fresh:
+			with self.lock:
+				self.counters['hits'] += 1
+		return fresh
+
+	def revalidate(self, entry, fileStat):
+		"""
+		Checks an entry against a fresh stat of its object. True when it is still current.
+		"""
+		with self.lock:
+			if not entry.matches(fileStat):
+				self.counters['stale'] += 1
+				return False
+
+			# The metadata may have changed without the contents.
+			entry.fileStat = fileStat
+			entry.validated = time.time()
+			self.counters['revalidations'] += 1
+			return True
+
+	def put(self, filename, content, fileStat):
+		"""
+		Caches the content read at the given stat. Returns the new entry, which is only
+		kept when the content fits.
+		"""
+		entry = CacheEntry(content, fileStat, time.time())
+		with self.lock:
+			self._remove(filename)
+			if len(content) > self.maxObjectBytes:
+				self.counters['uncacheable'] += 1
+				return entry
+
+			self.entries[filename] = entry
+			self.size += len(content)
+			while self.size > self.maxBytes:
+				(_, evicted) = self.entries.popitem(last=False)
+				self.size -= len(evicted.content)
+				self.counters['evictions'] += 1
+		return entry
+
+	def invalidate(self, filename):
+		with self.lock:
+			self._remove(filename)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.size = 0
+
+	def stats(self):
+		with self.lock:
+			stats = dict(self.counters)
+			stats['entries'] = len(self.entries)
+			stats['bytes'] = self.size
+			stats['max_bytes'] = self.maxBytes
+			return stats
+
+	def _remove(self, filename):
+		entry = self.entries.pop(filename, None)
+		if entry is not None:
+			self.size -= len(entry.content)
+
+class LookupCache(object):
+	"""
+	Instance-local LRU cache of small lookup results, bounded by the number of entries.
+
+	Every entry expires `ttl` seconds after it was stored.
+	"""
+	def __init__(self, maxEntries, ttl):
+		self.maxEntries = maxEntries
+		self.ttl = ttl
+
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.counters = collections.Counter()
+
+	def get(self, key):
+		"""
+		Returns the value stored for key, or None when it is unknown or expired.
+		"""
+		with self.lock:
+			item = self.entries.pop(key, None)
+			if item is None:
+				self.counters['misses'] += 1
+				return None
+
+			(value, expires) = item
+			if expires <= time.time():
+				self.counters['expired'] += 1
+				return None
+
+			self.entries[key] = item
+			self.counters['hits'] += 1
+			return value
+
+	def put(self, key, value):
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = (value, time.time() + self.ttl)
+			while len(self.entries) > self.maxEntries:
+				self.entries.popitem(last=False)
+				self.counters['evictions'] += 1
+
+	def invalidate(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def stats(self):
+		with self.lock:
+			stats = dict(self.counters)
+			stats['entries'] = len(self.entries)
+			stats['max_entries'] = self.maxEntries
+			return stats
@@ -17,8 +17,12 @@
 
 
 
+from .api_utils import get_hedge_policy
+from .api_utils import get_retry_stats
+from .api_utils import HedgePolicy
 from .api_utils import RetryParams
 from .api_utils import set_default_retry_params
+from .api_utils import set_hedge_policy
 from cloudstorage_api import *
 from .common import CSFileStat
 from .common import GCSFileStat
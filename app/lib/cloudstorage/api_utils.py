@@ -16,15 +16,21 @@
 
 
 
-__all__ = ['set_default_retry_params',
+__all__ = ['get_hedge_policy',
+           'get_retry_stats',
+           'set_default_retry_params',
+           'set_hedge_policy',
+           'HedgePolicy',
            'RetryParams',
           ]
 
+import collections
 import copy
+from email import utils as email_utils
 import httplib
 import logging
-import math
 import os
+import random
 import threading
 import time
 import urllib
@@ -82,6 +88,37 @@ def _get_default_retry_params():
     return copy.copy(default)
 
 
+def _get_default_retry_params_key():
+  """Get the settings key of the default RetryParams, without copying it.
+
+  Returns:
+    The settings key of the default RetryParams for current request and
+    current thread, or None if the library defaults apply.
+  """
+  default = getattr(_thread_local_settings, 'default_retry_params', None)
+  if default is None or not default.belong_to_current_request():
+    return None
+  return default._settings_key()
+
+
+def set_hedge_policy(hedge_policy):
+  """Set the HedgePolicy for GET and HEAD requests of this process.
+
+  Args:
+    hedge_policy: a HedgePolicy instance, or None to disable hedging.
+  """
+  global _hedge_policy
+  _hedge_policy = hedge_policy
+
+
+def get_hedge_policy():
+  """Get the HedgePolicy of this process, None if hedging is disabled."""
+  return _hedge_policy
+
+
+_hedge_policy = None
+
+
 def _quote_filename(filename):
   """Quotes filename to use as a valid URI path.
 
@@ -110,18 +147,97 @@ def _unquote_filename(filename):
 
 def _should_retry(resp):
   """Given a urlfetch response, decide whether to retry that request."""
-  return (resp.status_code == httplib.REQUEST_TIMEOUT or
+  return (resp.status_code in (httplib.REQUEST_TIMEOUT, 429) or
           (resp.status_code >= 500 and
            resp.status_code < 600))
 
 
+def _get_retry_after(resp):
+  """Get the seconds a response asks to wait before retrying.
+
+  Args:
+    resp: a urlfetch response.
+
+  Returns:
+    The seconds from the Retry-After header, either given as seconds or as
+    an HTTP date. None if there is no valid header.
+  """
+  headers = getattr(resp, 'headers', None)
+  value = headers.get('retry-after') if headers else None
+  if not value:
+    return None
+  try:
+    return max(float(value), 0)
+  except ValueError:
+    pass
+  parsed = email_utils.parsedate_tz(value)
+  if parsed is None:
+    return None
+  return max(email_utils.mktime_tz(parsed) - time.time(), 0)
+
+
+class _RetryBudget(object):
+  """Process wide token bucket that caps retries to a fraction of requests.
+
+  Every request deposits ratio tokens, up to max_tokens, and every retry
+  withdraws one. When storage keeps failing, the bucket runs empty and
+  requests fail after their first attempt instead of multiplying the load.
+  """
+
+  def __init__(self, ratio=0.1, max_tokens=10):
+    self.ratio = ratio
+    self.max_tokens = max_tokens
+    self._lock = threading.Lock()
+    self._tokens = float(max_tokens)
+    self._counters = collections.Counter()
+
+  def record_request(self):
+    with self._lock:
+      self._tokens = min(self._tokens + self.ratio, self.max_tokens)
+      self._counters['requests'] += 1
+
+  def withdraw(self):
+    """Take the token for one retry. False if the budget is exhausted."""
+    with self._lock:
+      if self._tokens < 1:
+        self._counters['budget_exhausted'] += 1
+        return False
+      self._tokens -= 1
+      self._counters['retries'] += 1
+      return True
+
+  def record_backoff(self, seconds):
+    with self._lock:
+      self._counters['backoff_seconds'] += seconds
+
+  def stats(self):
+    with self._lock:
+      stats = dict(self._counters)
+      stats['budget_tokens'] = self._tokens
+      return stats
+
+
+_retry_budget = _RetryBudget()
+
+
+def get_retry_stats():
+  """Get the retry counters of this process.
+
+  Returns:
+    A dict with the number of requests, retries, retries refused because the
+    retry budget was exhausted, and the seconds spent in backoff.
+  """
+  return _retry_budget.stats()
+
+
 class _RetryWrapper(object):
   """A wrapper that wraps retry logic around any tasklet."""
 
   def __init__(self,
                retry_params,
                retriable_exceptions=_RETRIABLE_EXCEPTIONS,
-               should_retry=lambda r: False):
+               should_retry=lambda r: False,
+               retry_budget=None):
     """Init.
 
     Args:
@@ -129,10 +245,13 @@ class _RetryWrapper(object):
       retriable_exceptions: a list of exception classes that are retriable.
       should_retry: a function that takes a result from the tasklet and returns
         a boolean. True if the result should be retried.
+      retry_budget: a _RetryBudget instance. If None, the one of this process
+        will be used.
     """
     self.retry_params = retry_params
     self.retriable_exceptions = retriable_exceptions
     self.should_retry = should_retry
+    self.retry_budget = retry_budget or _retry_budget
 
   @ndb.tasklet
   def run(self, tasklet, **kwds):
@@ -154,6 +273,8 @@ class _RetryWrapper(object):
     """
     start_time = time.time()
     n = 1
+    delay = None
+    self.retry_budget.record_request()
 
     while True:
       e = None
@@ -176,9 +297,24 @@ class _RetryWrapper(object):
       if n == 1:
         logging.debug('Tasklet is %r', tasklet)
 
-      delay = self.retry_params.delay(n, start_time)
+      delay = self.retry_params.delay(n, start_time, delay)
+      sleep = delay
 
-      if delay <= 0:
+      retry_after = _get_retry_after(result) if got_result else None
+      if sleep > 0 and retry_after is not None:
+        if (time.time() + retry_after - start_time >
+            self.retry_params.max_retry_period):
+          logging.debug('Retry-After of %s seconds exceeds max_retry_period',
+                        retry_after)
+          sleep = -1
+        else:
+          sleep = max(sleep, retry_after)
+
+      if sleep > 0 and not self.retry_budget.withdraw():
+        logging.debug('Retry budget is exhausted.')
+        sleep = -1
+
+      if sleep <= 0:
         logging.debug(
             'Tasklet failed after %s attempts and %s seconds in total',
             n, time.time() - start_time)
@@ -195,9 +331,10 @@ class _RetryWrapper(object):
       else:
         logging.debug(
             'Got exception "%r" from tasklet.', e)
-      logging.debug('Retry in %s seconds.', delay)
+      logging.debug('Retry in %s seconds.', sleep)
       n += 1
-      yield tasklets.sleep(delay)
+      self.retry_budget.record_backoff(sleep)
+      yield tasklets.sleep(sleep)
 
 
 class RetryParams(object):
@@ -267,6 +404,15 @@ class RetryParams(object):
   def __ne__(self, other):
     return not self.__eq__(other)
 
+  def _settings_key(self):
+    """Returns the settings as a hashable key, regardless of the request.
+
+    Two instances with the same key behave the same, even if they were
+    created for different requests.
+    """
+    return tuple(sorted((k, v) for k, v in self.__dict__.iteritems()
+                        if k != '_request_id'))
+
   @classmethod
   def _check(cls, name, val, can_be_zero=False, val_type=float):
     """Check init arguments.
@@ -302,12 +448,17 @@ class RetryParams(object):
   def belong_to_current_request(self):
     return os.getenv('REQUEST_LOG_ID') == self._request_id
 
-  def delay(self, n, start_time):
+  def delay(self, n, start_time, prev_delay=None):
     """Calculate delay before the next retry.
 
+    The delay is drawn at random between initial_delay and backoff_factor
+    times the previous delay, capped by max_delay. Clients that failed at the
+    same time thus do not retry in lockstep.
+
     Args:
       n: the number of current attempt. The first attempt should be 1.
       start_time: the time when retry started in unix time.
+      prev_delay: the delay before the current attempt. None for the first.
 
     Returns:
       Number of seconds to wait before next retry. -1 if retry should give up.
@@ -316,9 +467,125 @@ class RetryParams(object):
         (n > self.min_retries and
          time.time() - start_time > self.max_retry_period)):
       return -1
-    return min(
-        math.pow(self.backoff_factor, n-1) * self.initial_delay,
-        self.max_delay)
+    upper = (prev_delay or self.initial_delay) * self.backoff_factor
+    return min(random.uniform(self.initial_delay, upper), self.max_delay)
+
+
+class HedgePolicy(object):
+  """Hedging configuration and latency statistics for idempotent requests.
+
+  A GET or HEAD that has not returned within the hedge delay gets a
+  duplicate request, and the first response wins. The delay is a percentile
+  of the recent latencies of the method, bounded by min_delay and max_delay.
+
+  Hedges are rate limited for the whole process and per path: every request
+  earns the process max_hedge_ratio hedges, at most max_hedge_burst of them
+  held in reserve, and its path the same ratio, at most one in reserve. So
+  neither slow objects nor many distinct paths can double the load.
+
+  The ndb event loop only runs the hedge timer when it wakes up, and while
+  RPCs are in flight it only wakes up when one of them completes. A request
+  that is the only one in flight is therefore never hedged, see
+  _StorageApi._hedged_request_async.
+
+  The policy is shared by all requests and threads of a process.
+  """
+
+  @datastore_rpc._positional(1)
+  def __init__(self,
+               percentile=95,
+               min_delay=0.01,
+               max_delay=1.0,
+               max_hedge_ratio=0.1,
+               max_hedge_burst=10,
+               sample_size=1000,
+               max_paths=4096):
+    """Init.
+
+    Args:
+      percentile: percentile of the recent latencies to hedge after.
+      min_delay: min seconds to wait before hedging.
+      max_delay: max seconds to wait before hedging. Also used until enough
+        latencies have been recorded.
+      max_hedge_ratio: max hedges per request, for the process and per path.
+      max_hedge_burst: max hedges the process holds in reserve.
+      sample_size: number of recent latencies kept per method.
+      max_paths: number of paths whose hedge allowance is tracked.
+    """
+    if not 0 < percentile < 100:
+      raise ValueError('Value for parameter percentile has to be in (0, 100)')
+    self.percentile = percentile
+    self.min_delay = RetryParams._check('min_delay', min_delay, True)
+    self.max_delay = RetryParams._check('max_delay', max_delay)
+    if self.min_delay > self.max_delay:
+      self.min_delay = self.max_delay
+    self.max_hedge_ratio = RetryParams._check('max_hedge_ratio',
+                                              max_hedge_ratio, True)
+    self.max_hedge_burst = RetryParams._check('max_hedge_burst',
+                                              max_hedge_burst, val_type=int)
+    self.sample_size = RetryParams._check('sample_size', sample_size,
+                                          val_type=int)
+    self.max_paths = RetryParams._check('max_paths', max_paths, val_type=int)
+
+    self._lock = threading.Lock()
+    self._latencies = {}
+    self._recorded = collections.Counter()
+    self._delays = {}
+    self._allowances = collections.OrderedDict()
+    self._budget = 0.0
+    self._counters = collections.Counter()
+
+  def stats(self):
+    """Get the counters of requests, hedges and hedges that won."""
+    with self._lock:
+      stats = dict(self._counters)
+      stats['delays'] = dict(self._delays)
+      return stats
+
+  def _hedge_delay(self, method):
+    """Seconds to wait for a response before hedging a request."""
+    return self._delays.get(method, self.max_delay)
+
+  def _record_request(self, path):
+    with self._lock:
+      self._counters['requests'] += 1
+      self._budget = min(self._budget + self.max_hedge_ratio,
+                         self.max_hedge_burst)
+      allowance = self._allowances.pop(path, 1.0)
+      self._allowances[path] = min(allowance + self.max_hedge_ratio, 1.0)
+      while len(self._allowances) > self.max_paths:
+        self._allowances.popitem(last=False)
+
+  def _allow_hedge(self, path):
+    """Take the allowance for one hedge of path. False if it is used up."""
+    with self._lock:
+      allowance = self._allowances.get(path, 0)
+      if allowance < 1 or self._budget < 1:
+        self._counters['rate_limited'] += 1
+        return False
+      self._allowances[path] = allowance - 1
+      self._budget -= 1
+      self._counters['hedges'] += 1
+      return True
+
+  def _record_hedge_win(self):
+    with self._lock:
+      self._counters['hedge_wins'] += 1
+
+  def _record_latency(self, method, latency):
+    with self._lock:
+      latencies = self._latencies.get(method)
+      if latencies is None:
+        latencies = self._latencies[method] = collections.deque(
+            maxlen=self.sample_size)
+      latencies.append(latency)
+      self._recorded[method] += 1
+      # Sorting on every request would cost more than it saves.
+      if self._recorded[method] % 50 == 0:
+        ordered = sorted(latencies)
+        index = int(len(ordered) * self.percentile / 100.0)
+        self._delays[method] = min(max(ordered[index], self.min_delay),
+                                   self.max_delay)
 
 
 def _run_until_rpc():
@@ -49,7 +49,9 @@ def open(filename,
          read_buffer_size=storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE,
          retry_params=None,
          _account_id=None,
-         offset=0):
+         offset=0,
+         length=None,
+         generation=None):
   """Opens a Google Cloud Storage file and returns it as a File-like object.
 
   Args:
@@ -74,6 +76,11 @@ def open(filename,
     _account_id: Internal-use only.
     offset: Number of bytes to skip at the start of the file. If None, 0 is
       used.
+    length: Number of bytes to read from offset on. If None, the file is read
+      up to its end. Only valid in reading mode.
+    generation: Generation of the object to read, e.g. from a GCSFileStat. If
+      set, every read fails once the object was overwritten, instead of
+      returning parts of another version. Only valid in reading mode.
 
   Returns:
     A reading or writing buffer that supports File-like interface. Buffer
@@ -82,6 +89,7 @@ def open(filename,
   Raises:
     errors.AuthorizationError: if authorization failed.
     errors.NotFoundError: if an object that's expected to exist doesn't.
+    errors.PreconditionFailedError: if the object is no longer at generation.
     ValueError: invalid open mode or if content_type or options are specified
       in reading mode.
   """
@@ -100,7 +108,9 @@ def open(filename,
     return storage_api.ReadBuffer(api,
                                   filename,
                                   buffer_size=read_buffer_size,
-                                  offset=offset)
+                                  offset=offset,
+                                  length=length,
+                                  generation=generation)
   else:
     raise ValueError('Invalid mode %s.' % mode)
 
@@ -155,7 +165,8 @@ def stat(filename, retry_params=None, _account_id=None):
       st_ctime=common.http_time_to_posix(headers.get('last-modified')),
       etag=headers.get('etag'),
       content_type=headers.get('content-type'),
-      metadata=common.get_metadata(headers))
+      metadata=common.get_metadata(headers),
+      generation=headers.get('x-goog-generation'))
 
   return file_stat
 
@@ -443,6 +454,10 @@ class _Bucket(object):
   def __iter__(self):
     """Iter over the bucket.
 
+    Every page is parsed in one pass while it is iterated. The request for
+    the next page is issued as soon as the page tells where it starts, so it
+    is in flight while the current page is consumed.
+
     Yields:
       GCSFileStat: a GCSFileStat for an object in the bucket.
         They are ordered by GCSFileStat.filename.
@@ -454,130 +469,92 @@ class _Bucket(object):
       status, resp_headers, content = self._get_bucket_fut.get_result()
       errors.check_status(status, [200], self._path, resp_headers=resp_headers,
                           body=content, extras=self._options)
+      self._get_bucket_fut = None
 
-      if self._should_get_another_batch(content):
-        self._get_bucket_fut = self._api.get_bucket_async(
-            self._path + '?' + urllib.urlencode(self._options))
-      else:
-        self._get_bucket_fut = None
-
-      root = ET.fromstring(content)
-      dirs = self._next_dir_gen(root)
-      files = self._next_file_gen(root)
-      next_file = files.next()
-      next_dir = dirs.next()
+      stats = self._parse_page(content)
+      if 'delimiter' in self._options:
+        # Files and directories are listed separately, the page is buffered
+        # to merge them by name.
+        stats = sorted(stats)
 
-      while ((max_keys is None or total < max_keys) and
-             not (next_file is None and next_dir is None)):
+      for stat in stats:
         total += 1
-        if next_file is None:
-          self._last_yield = next_dir
-          next_dir = dirs.next()
-        elif next_dir is None:
-          self._last_yield = next_file
-          next_file = files.next()
-        elif next_dir < next_file:
-          self._last_yield = next_dir
-          next_dir = dirs.next()
-        elif next_file < next_dir:
-          self._last_yield = next_file
-          next_file = files.next()
-        else:
-          logging.error(
-              'Should never reach. next file is %r. next dir is %r.',
-              next_file, next_dir)
+        self._last_yield = stat
         if self._new_max_keys:
           self._new_max_keys -= 1
-        yield self._last_yield
+        yield stat
+        if max_keys is not None and total >= max_keys:
+          return
 
-  def _next_file_gen(self, root):
-    """Generator for next file element in the document.
+  def _parse_page(self, content):
+    """Generator for the files and directories of a GET bucket response.
 
-    Args:
-      root: root element of the XML tree.
-
-    Yields:
-      GCSFileStat for the next file.
-    """
-    for e in root.getiterator(common._T_CONTENTS):
-      st_ctime, size, etag, key = None, None, None, None
-      for child in e.getiterator('*'):
-        if child.tag == common._T_LAST_MODIFIED:
-          st_ctime = common.dt_str_to_posix(child.text)
-        elif child.tag == common._T_ETAG:
-          etag = child.text
-        elif child.tag == common._T_SIZE:
-          size = child.text
-        elif child.tag == common._T_KEY:
-          key = child.text
-      yield common.GCSFileStat(self._path + '/' + key,
-                               size, etag, st_ctime)
-      e.clear()
-    yield None
-
-  def _next_dir_gen(self, root):
-    """Generator for next directory element in the document.
+    Issues the GET bucket call for the next page once the response tells
+    whether it is truncated and what its next marker is.
 
     Args:
-      root: root element in the XML tree.
+      content: response XML.
 
     Yields:
-      GCSFileStat for the next directory.
+      GCSFileStat for the next file or directory, in document order.
     """
-    for e in root.getiterator(common._T_COMMON_PREFIXES):
-      yield common.GCSFileStat(
-          self._path + '/' + e.find(common._T_PREFIX).text,
-          st_size=None, etag=None, st_ctime=None, is_dir=True)
-      e.clear()
-    yield None
-
-  def _should_get_another_batch(self, content):
-    """Whether to issue another GET bucket call.
+    decided = ('max-keys' in self._options and
+               self._options['max-keys'] <= common._MAX_GET_BUCKET_RESULT)
+    is_truncated, next_marker = None, None
+
+    for _, e in ET.iterparse(StringIO.StringIO(content)):
+      stat = None
+      if e.tag == common._T_CONTENTS:
+        stat = self._file_stat(e)
+      elif e.tag == common._T_COMMON_PREFIXES:
+        stat = common.GCSFileStat(
+            self._path + '/' + e.find(common._T_PREFIX).text,
+            st_size=None, etag=None, st_ctime=None, is_dir=True)
+      elif e.tag == common._T_IS_TRUNCATED:
+        is_truncated = e.text
+      elif e.tag == common._T_NEXT_MARKER:
+        next_marker = e.text
+
+      if (not decided and is_truncated is not None and
+          (next_marker is not None or is_truncated.lower() != 'true')):
+        decided = True
+        self._get_next_page(is_truncated, next_marker)
+
+      if stat is not None:
+        # Only the emptied element stays in the tree.
+        e.clear()
+        yield stat
+
+    if not decided:
+      self._get_next_page(is_truncated, next_marker)
+
+  def _file_stat(self, e):
+    """Get the GCSFileStat of a Contents element."""
+    st_ctime, size, etag, key = None, None, None, None
+    for child in e:
+      if child.tag == common._T_LAST_MODIFIED:
+        st_ctime = common.dt_str_to_posix(child.text)
+      elif child.tag == common._T_ETAG:
+        etag = child.text
+      elif child.tag == common._T_SIZE:
+        size = child.text
+      elif child.tag == common._T_KEY:
+        key = child.text
+    return common.GCSFileStat(self._path + '/' + key,
+                              size, etag, st_ctime)
+
+  def _get_next_page(self, is_truncated, next_marker):
+    """Issue the GET bucket call for the next page, if there is one.
 
     Args:
-      content: response XML.
-
-    Returns:
-      True if should, also update self._options for the next request.
-      False otherwise.
+      is_truncated: text of the IsTruncated element, None if missing.
+      next_marker: text of the NextMarker element, None if missing.
     """
-    if ('max-keys' in self._options and
-        self._options['max-keys'] <= common._MAX_GET_BUCKET_RESULT):
-      return False
-
-    elements = self._find_elements(
-        content, set([common._T_IS_TRUNCATED,
-                      common._T_NEXT_MARKER]))
-    if elements.get(common._T_IS_TRUNCATED, 'false').lower() != 'true':
-      return False
-
-    next_marker = elements.get(common._T_NEXT_MARKER)
+    if (is_truncated or 'false').lower() != 'true':
+      return
     if next_marker is None:
       self._options.pop('marker', None)
-      return False
+      return
     self._options['marker'] = next_marker
-    return True
-
-  def _find_elements(self, result, elements):
-    """Find interesting elements from XML.
-
-    This function tries to only look for specified elements
-    without parsing the entire XML. The specified elements is better
-    located near the beginning.
-
-    Args:
-      result: response XML.
-      elements: a set of interesting element tags.
-
-    Returns:
-      A dict from element tag to element value.
-    """
-    element_mapping = {}
-    result = StringIO.StringIO(result)
-    for _, e in ET.iterparse(result, events=('end',)):
-      if not elements:
-        break
-      if e.tag in elements:
-        element_mapping[e.tag] = e.text
-        elements.remove(e.tag)
-    return element_mapping
+    self._get_bucket_fut = self._api.get_bucket_async(
+        self._path + '?' + urllib.urlencode(self._options))
@@ -58,6 +58,7 @@ _GCS_BUCKET_REGEX = re.compile(_GCS_BUCKET_REGEX_BASE + r'$')
 _GCS_BUCKET_PATH_REGEX = re.compile(r'/' + _GCS_BUCKET_REGEX_BASE + r'$')
 _GCS_PATH_PREFIX_REGEX = re.compile(r'/' + _GCS_BUCKET_REGEX_BASE + r'.*')
 _GCS_FULLPATH_REGEX = re.compile(r'/' + _GCS_BUCKET_REGEX_BASE + r'/.*')
+_CONTENT_RANGE_REGEX = re.compile(r'bytes \d+-\d+/(\d+)$')
 _GCS_METADATA = ['x-goog-meta-',
                  'content-disposition',
                  'cache-control',
@@ -105,7 +106,8 @@ class GCSFileStat(object):
                st_ctime,
                content_type=None,
                metadata=None,
-               is_dir=False):
+               is_dir=False,
+               generation=None):
     """Initialize.
 
     For files, the non optional arguments are always set.
@@ -121,6 +123,8 @@ class GCSFileStat(object):
         the file. Possible keys are x-goog-meta-, content-disposition,
         content-encoding, and cache-control.
       is_dir: True if this represents a directory. False if this is a real file.
+      generation: generation of the object, changes on every overwrite. str.
+        None when unknown.
     """
     self.filename = filename
     self.is_dir = is_dir
@@ -129,6 +133,7 @@ class GCSFileStat(object):
     self.etag = None
     self.content_type = content_type
     self.metadata = metadata
+    self.generation = generation
 
     if not is_dir:
       self.st_size = long(st_size)
@@ -145,13 +150,15 @@ class GCSFileStat(object):
         '(filename: %(filename)s, st_size: %(st_size)s, '
         'st_ctime: %(st_ctime)s, etag: %(etag)s, '
         'content_type: %(content_type)s, '
-        'metadata: %(metadata)s)' %
+        'metadata: %(metadata)s, '
+        'generation: %(generation)s)' %
         dict(filename=self.filename,
              st_size=self.st_size,
              st_ctime=self.st_ctime,
              etag=self.etag,
              content_type=self.content_type,
-             metadata=self.metadata))
+             metadata=self.metadata,
+             generation=self.generation))
 
   def __cmp__(self, other):
     if not isinstance(other, self.__class__):
@@ -192,6 +199,21 @@ def get_stored_content_length(headers):
   return length
 
 
+def get_content_range_size(headers):
+  """Return the total size (in bytes) of the object from a Content-Range header.
+
+  Args:
+    headers: a dict of headers from the http response to a ranged GET.
+
+  Returns:
+    the object size as long. None if the header is absent or has no total size.
+  """
+  match = _CONTENT_RANGE_REGEX.match(headers.get('content-range', ''))
+  if match is None:
+    return None
+  return long(match.group(1))
+
+
 def get_metadata(headers):
   """Get user defined options from HTTP response headers."""
   return dict((k, v) for k, v in headers.iteritems()
@@ -342,6 +364,7 @@ def posix_time_to_http(posix_time):
 
 
 _DT_FORMAT = '%Y-%m-%dT%H:%M:%S'
+_DT_REGEX = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})$')
 
 
 def dt_str_to_posix(dt_str):
@@ -364,7 +387,12 @@ def dt_str_to_posix(dt_str):
     1970/1/1 UTC.
   """
   parsable, _ = dt_str.split('.')
-  dt = datetime.datetime.strptime(parsable, _DT_FORMAT)
+  # strptime is slow, and this runs for every object of a listing.
+  match = _DT_REGEX.match(parsable)
+  if match is None:
+    raise ValueError('time data %r does not match format %r' %
+                     (parsable, _DT_FORMAT))
+  dt = datetime.datetime(*[int(group) for group in match.groups()])
   return calendar.timegm(dt.utctimetuple())
 
 
@@ -26,6 +26,7 @@ __all__ = ['AuthorizationError',
            'ForbiddenError',
            'InvalidRange',
            'NotFoundError',
+           'PreconditionFailedError',
            'ServerError',
            'TimeoutError',
            'TransientError',
@@ -89,6 +90,10 @@ class InvalidRange(FatalError):
   """HTTP 416 RequestRangeNotSatifiable."""
 
 
+class PreconditionFailedError(FatalError):
+  """HTTP 412 Precondition Failed, e.g. the object is at another generation."""
+
+
 class ServerError(TransientError):
   """HTTP >= 500 server side error."""
 
@@ -109,6 +114,7 @@ def check_status(status, expected, path, headers=None,
   Raises:
     AuthorizationError: if authorization failed.
     NotFoundError: if an object that's expected to exist doesn't.
+    PreconditionFailedError: if a precondition of the request failed.
     TimeoutError: if HTTP request timed out.
     ServerError: if server experienced some errors.
     FatalError: if any other unexpected errors occurred.
@@ -134,6 +140,8 @@ def check_status(status, expected, path, headers=None,
     raise TimeoutError(msg)
   elif status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
     raise InvalidRange(msg)
+  elif status == httplib.PRECONDITION_FAILED:
+    raise PreconditionFailedError(msg)
   elif (status == httplib.OK and 308 in expected and
         httplib.OK not in expected):
     raise FileClosedError(msg)
@@ -23,6 +23,7 @@ __all__ = ['add_sync_methods']
 import logging
 import os
 import random
+import threading
 import time
 
 from . import api_utils
@@ -104,6 +105,81 @@ def _make_token_async(scopes, service_account_id):
   raise ndb.Return((token, expires_at))
 
 
+_TOKEN_REFRESH_TIMEOUT = 5
+
+
+class _TokenRefresh(object):
+  """A token refresh in flight, see _TokenCache.begin_refresh."""
+
+  def __init__(self):
+    self.thread = threading.current_thread()
+    self.future = None
+    self.done = threading.Event()
+
+
+class _TokenCache(object):
+  """Process wide cache of authentication tokens, shared by all threads.
+
+  Tokens are keyed like in memcache, by service account and scopes.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._tokens = {}
+    self._refreshes = {}
+
+  def get(self, key, headroom):
+    """Get the cached token for key.
+
+    Args:
+      key: the token key.
+      headroom: seconds the token has to stay valid for.
+
+    Returns:
+      The token, or None if there is none valid for headroom seconds.
+    """
+    item = self._tokens.get(key)
+    if item is None or item[1] < time.time() + headroom:
+      return None
+    return item[0]
+
+  def begin_refresh(self, key):
+    """Join the refresh of the token for key, or start one.
+
+    Args:
+      key: the token key.
+
+    Returns:
+      A tuple (refresh, owner). If owner is True, the caller started the
+      refresh and has to finish it with end_refresh.
+    """
+    with self._lock:
+      flight = self._refreshes.get(key)
+      if flight is not None:
+        return flight, False
+      flight = self._refreshes[key] = _TokenRefresh()
+      return flight, True
+
+  def end_refresh(self, key, flight, token=None, expires_at=None):
+    """Finish a refresh started by begin_refresh.
+
+    Args:
+      key: the token key.
+      flight: the refresh returned by begin_refresh.
+      token: the new token, None if the refresh failed.
+      expires_at: expiration time of the token in seconds since the epoch.
+    """
+    with self._lock:
+      if token is not None:
+        self._tokens[key] = (token, expires_at)
+      if self._refreshes.get(key) is flight:
+        del self._refreshes[key]
+    flight.done.set()
+
+
+_token_cache = _TokenCache()
+
+
 class _RestApi(object):
   """Base class for REST-based API wrapper classes.
 
@@ -194,9 +270,13 @@ class _RestApi(object):
   def get_token_async(self, refresh=False):
     """Get an authentication token.
 
-    The token is cached in memcache, keyed by the scopes argument.
-    Uses a random token expiration headroom value generated in the constructor
-    to eliminate a burst of GET_ACCESS_TOKEN API requests.
+    The token is cached in process and in memcache, keyed by the scopes
+    argument. Uses a random token expiration headroom value generated in the
+    constructor to eliminate a burst of GET_ACCESS_TOKEN API requests.
+
+    Only one caller at a time refreshes a token. Meanwhile the others keep
+    using the current token as long as it has not expired, or wait for the
+    refresh otherwise.
 
     Args:
       refresh: If True, ignore a cached token; default False.
@@ -205,6 +285,50 @@ class _RestApi(object):
       An authentication token. This token is guaranteed to be non-expired.
     """
     key = '%s,%s' % (self.service_account_id, ','.join(self.scopes))
+    if not refresh:
+      token = _token_cache.get(key, self.expiration_headroom)
+      if token is not None:
+        raise ndb.Return(token)
+
+    flight, owner = _token_cache.begin_refresh(key)
+    if owner:
+      flight.future = self._refresh_token_async(key, refresh, flight)
+      token = yield flight.future
+      raise ndb.Return(token)
+
+    token = _token_cache.get(key, 0)
+    if token is not None and not refresh:
+      raise ndb.Return(token)
+    if flight.thread is threading.current_thread():
+      # The refresh runs on the event loop of this thread, blocking here
+      # would stall it.
+      token = yield flight.future
+      raise ndb.Return(token)
+
+    flight.done.wait(_TOKEN_REFRESH_TIMEOUT)
+    token = _token_cache.get(key, 0)
+    if token is None:
+      # The refresh failed or is stuck, try on our own.
+      token, _ = yield self._fetch_token_async(key, refresh)
+    raise ndb.Return(token)
+
+  @ndb.tasklet
+  def _refresh_token_async(self, key, refresh, flight):
+    """Fetch a token and store it in the process wide cache."""
+    token = expires_at = None
+    try:
+      token, expires_at = yield self._fetch_token_async(key, refresh)
+    finally:
+      _token_cache.end_refresh(key, flight, token, expires_at)
+    raise ndb.Return(token)
+
+  @ndb.tasklet
+  def _fetch_token_async(self, key, refresh):
+    """Get a token from memcache, or a fresh one.
+
+    Yields:
+      A tuple (token, expiration_time).
+    """
     ts = yield _AE_TokenStorage_.get_by_id_async(
         key, use_cache=True, use_memcache=True,
         use_datastore=self.retry_params.save_access_token)
@@ -218,7 +342,7 @@ class _RestApi(object):
         yield ts.put_async(memcache_timeout=timeout,
                            use_datastore=self.retry_params.save_access_token,
                            use_cache=True, use_memcache=True)
-    raise ndb.Return(ts.token)
+    raise ndb.Return((ts.token, ts.expires))
 
   @ndb.tasklet
   def urlfetch_async(self, url, method='GET', headers=None,
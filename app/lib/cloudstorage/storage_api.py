@@ -24,6 +24,8 @@ __all__ = ['ReadBuffer',
 
 import collections
 import os
+import threading
+import time
 import urlparse
 
 from . import api_utils
@@ -34,9 +36,11 @@ from . import rest_api
 try:
   from google.appengine.api import urlfetch
   from google.appengine.ext import ndb
+  from google.appengine.ext.ndb import eventloop
 except ImportError:
   from google.appengine.api import urlfetch
   from google.appengine.ext import ndb
+  from google.appengine.ext.ndb import eventloop
 
 
 
@@ -53,17 +57,38 @@ def _get_storage_api(retry_params, account_id=None):
     On dev appserver, this instance by default will talk to a local stub
     unless common.ACCESS_TOKEN is set. That token will be used to talk
     to the real GCS.
+
+    Instances are pooled per process and shared by all requests and threads
+    with the same retry settings and account, so that their tokens are
+    reused as well.
   """
+  if retry_params:
+    settings_key = retry_params._settings_key()
+  else:
+    settings_key = api_utils._get_default_retry_params_key()
+  access_token = common.get_access_token()
+  key = (settings_key, account_id, access_token)
+
+  api = _api_pool.get(key)
+  if api is not None:
+    return api
+
+  with _api_pool_lock:
+    api = _api_pool.get(key)
+    if api is None:
+      api = _StorageApi(_StorageApi.full_control_scope,
+                        service_account_id=account_id,
+                        retry_params=retry_params)
+      if common.local_run() and not access_token:
+        api.api_url = common.local_api_url()
+      if access_token:
+        api.token = access_token
+      _api_pool[key] = api
+  return api
 
 
-  api = _StorageApi(_StorageApi.full_control_scope,
-                    service_account_id=account_id,
-                    retry_params=retry_params)
-  if common.local_run() and not common.get_access_token():
-    api.api_url = common.local_api_url()
-  if common.get_access_token():
-    api.token = common.get_access_token()
-  return api
+_api_pool = {}
+_api_pool_lock = threading.Lock()
 
 
 class _StorageApi(rest_api._RestApi):
@@ -116,22 +141,88 @@ class _StorageApi(rest_api._RestApi):
     """Inherit docs.
 
     This method translates urlfetch exceptions to more service specific ones.
+    GET and HEAD requests are hedged according to the HedgePolicy set by
+    api_utils.set_hedge_policy.
     """
     if headers is None:
       headers = {}
     if 'x-goog-api-version' not in headers:
       headers['x-goog-api-version'] = '2'
     headers['accept-encoding'] = 'gzip, *'
+    hedge_policy = api_utils.get_hedge_policy()
     try:
-      resp_tuple = yield super(_StorageApi, self).do_request_async(
-          url, method=method, headers=headers, payload=payload,
-          deadline=deadline, callback=callback)
+      if (hedge_policy is not None and method in ('GET', 'HEAD') and
+          callback is None):
+        resp_tuple = yield self._hedged_request_async(
+            hedge_policy, url, method, headers, deadline)
+      else:
+        resp_tuple = yield super(_StorageApi, self).do_request_async(
+            url, method=method, headers=headers, payload=payload,
+            deadline=deadline, callback=callback)
     except urlfetch.DownloadError, e:
       raise errors.TimeoutError(
           'Request to Google Cloud Storage timed out.', e)
 
     raise ndb.Return(resp_tuple)
 
+  def _hedged_request_async(self, hedge_policy, url, method, headers,
+                            deadline):
+    """Issue a request, and a duplicate of it if it is slow.
+
+    The duplicate is issued once the hedge delay has passed, if the policy
+    allows it for the path. The first successful response wins, the other one
+    is dropped. The request only fails if both fail.
+
+    The ndb event loop runs the hedge timer when it wakes up. While RPCs are
+    in flight it only wakes up when one of them completes, so the delay is a
+    lower bound. Hedging is therefore effective when several requests are in
+    flight, like the segments ReadBuffer reads ahead.
+
+    Args:
+      hedge_policy: an api_utils.HedgePolicy instance.
+      url: the url to fetch.
+      method: GET or HEAD.
+      headers: the http headers.
+      deadline: the deadline in which to make the call.
+
+    Returns:
+      A ndb Future, see do_request_async.
+    """
+    result = ndb.Future()
+    path = url.split('?', 1)[0]
+    pending = [0]
+
+    def issue(hedge):
+      start = time.time()
+      pending[0] += 1
+      future = super(_StorageApi, self).do_request_async(
+          url, method=method, headers=headers, deadline=deadline)
+      future.add_immediate_callback(complete, future, start, hedge)
+
+    def complete(future, start, hedge):
+      pending[0] -= 1
+      e = future.get_exception()
+      if e is None:
+        hedge_policy._record_latency(method, time.time() - start)
+      if result.done() or (e is not None and pending[0]):
+        return
+      if e is not None:
+        result.set_exception(e, future.get_traceback())
+        return
+      if hedge:
+        hedge_policy._record_hedge_win()
+      result.set_result(future.get_result())
+
+    def hedge():
+      if not result.done() and hedge_policy._allow_hedge(path):
+        issue(True)
+
+    hedge_policy._record_request(path)
+    issue(False)
+    if not result.done():
+      eventloop.queue_call(hedge_policy._hedge_delay(method), hedge)
+    return result
+
 
   def post_object_async(self, path, **kwds):
     """POST to an object."""
@@ -207,29 +298,49 @@ _StorageApi = rest_api.add_sync_methods(_StorageApi)
 
 
 class ReadBuffer(object):
-  """A class for reading Google storage files."""
+  """A class for reading Google storage files.
+
+  The read-ahead adapts to the access pattern. Every further buffer read in
+  order doubles the amount of bytes prefetched, up to max_read_ahead, spread
+  over at most MAX_SEGMENTS_IN_FLIGHT concurrent requests. A seek elsewhere
+  shrinks it back to a single buffer.
+  """
 
   DEFAULT_BUFFER_SIZE = 1024 * 1024
   MAX_REQUEST_SIZE = 30 * DEFAULT_BUFFER_SIZE
+  DEFAULT_MAX_READ_AHEAD = 8 * DEFAULT_BUFFER_SIZE
+  MAX_SEGMENTS_IN_FLIGHT = 4
 
   def __init__(self,
                api,
                path,
                buffer_size=DEFAULT_BUFFER_SIZE,
                max_request_size=MAX_REQUEST_SIZE,
-               offset=0):
+               offset=0,
+               length=None,
+               max_read_ahead=DEFAULT_MAX_READ_AHEAD,
+               generation=None):
     """Constructor.
 
     Args:
       api: A StorageApi instance.
       path: Quoted/escaped path to the object, e.g. /mybucket/myfile
       buffer_size: buffer size. The ReadBuffer keeps
-        one buffer. But there may be a pending future that contains
-        a second buffer. This size must be less than max_request_size.
+        one buffer. But there may be pending futures that contain
+        the next buffers. This size must be less than max_request_size.
       max_request_size: Max bytes to request in one urlfetch.
       offset: Number of bytes to skip at the start of the file. If None, 0 is
         used.
+      length: Number of bytes to read from offset on. If None, the file is read
+        up to its end. Nothing beyond offset + length is ever requested, not
+        even by prefetching.
+      max_read_ahead: Max bytes prefetched during sequential reads. At least
+        buffer_size is always prefetched.
+      generation: If set, every request is conditional on the object being at
+        this generation. Reads fail with errors.PreconditionFailedError once
+        the object was overwritten.
     """
+    assert length is None or length > 0
     self._api = api
     self._path = path
     self.name = api_utils._unquote_filename(path)
@@ -238,25 +349,51 @@ class ReadBuffer(object):
     assert buffer_size <= max_request_size
     self._buffer_size = buffer_size
     self._max_request_size = max_request_size
+    self._max_read_ahead = max(max_read_ahead, buffer_size)
     self._offset = offset
+    self._generation = generation
 
     self._buffer = _Buffer()
     self._etag = None
+    self._reset_read_ahead()
+
+    first_request_size = self._buffer_size
+    if length is not None:
+      first_request_size = min(first_request_size, length)
+    get_future = self._get_segment(offset, first_request_size, check_response=False)
+    content, check_response_closure, status, resp_headers = get_future.get_result()
+
+    # The size and etag normally come with the first segment. Only when the
+    # response lacks them, e.g. for an empty file, a HEAD request is needed.
+    self._file_size = None
+    if status == 206:
+      self._file_size = common.get_content_range_size(resp_headers)
+    elif status == 200:
+      # The whole file was returned, only the requested window is kept.
+      stored_length = common.get_stored_content_length(resp_headers)
+      if stored_length is not None:
+        self._file_size = long(stored_length)
+      content = content[offset:offset + first_request_size]
+    elif status != 416:
+      # E.g. a missing file, no need to ask again.
+      check_response_closure()
 
-    get_future = self._get_segment(offset, self._buffer_size, check_response=False)
-
-    status, headers, content = self._api.head_object(path)
-    errors.check_status(status, [200], path, resp_headers=headers, body=content)
-    self._file_size = long(common.get_stored_content_length(headers))
-    self._check_etag(headers.get('etag'))
+    if self._file_size is None:
+      status, headers, head_content = self._api.head_object(
+          path, headers=self._conditions())
+      errors.check_status(status, [200], path, resp_headers=headers, body=head_content)
+      self._file_size = long(common.get_stored_content_length(headers))
+      self._check_etag(headers.get('etag'))
 
-    self._buffer_future = None
+    self._end = self._file_size
+    if length is not None:
+      self._end = min(self._end, offset + length)
 
     if self._file_size != 0:
-      content, check_response_closure = get_future.get_result()
       check_response_closure()
       self._buffer.reset(content)
-      self._request_next_buffer()
+      self._reset_read_ahead()
+      self._fill_read_ahead()
 
   def __getstate__(self):
     """Store state as part of serialization/pickling.
@@ -273,9 +410,12 @@ class ReadBuffer(object):
             'path': self._path,
             'buffer_size': self._buffer_size,
             'request_size': self._max_request_size,
+            'read_ahead': self._max_read_ahead,
             'etag': self._etag,
             'size': self._file_size,
+            'end': self._end,
             'offset': self._offset,
+            'generation': self._generation,
             'closed': self.closed}
 
   def __setstate__(self, state):
@@ -291,14 +431,17 @@ class ReadBuffer(object):
     self.name = api_utils._unquote_filename(self._path)
     self._buffer_size = state['buffer_size']
     self._max_request_size = state['request_size']
+    self._max_read_ahead = state.get('read_ahead', self.DEFAULT_MAX_READ_AHEAD)
     self._etag = state['etag']
     self._file_size = state['size']
+    self._end = state.get('end', self._file_size)
     self._offset = state['offset']
+    self._generation = state.get('generation')
     self._buffer = _Buffer()
     self.closed = state['closed']
-    self._buffer_future = None
+    self._reset_read_ahead()
     if self._remaining() and not self.closed:
-      self._request_next_buffer()
+      self._fill_read_ahead()
 
   def __iter__(self):
     """Iterator interface.
@@ -352,8 +495,8 @@ class ReadBuffer(object):
       data_list.append(data)
       if size == 0 or not self._remaining():
         return ''.join(data_list)
-      self._buffer.reset(self._buffer_future.get_result())
-      self._request_next_buffer()
+      self._next_buffer()
+      self._fill_read_ahead()
       newline_offset = self._buffer.find_newline(size)
 
     data = self._buffer.read_to_offset(newline_offset + 1)
@@ -391,37 +534,67 @@ class ReadBuffer(object):
         size -= remaining
         self._offset += remaining
         data_list.append(self._buffer.read())
+        if size == 0 or not self._remaining():
+          break
 
-        if self._buffer_future is None:
+        if not self._buffer_futures:
           if size < 0 or size >= self._remaining():
             needs = self._remaining()
           else:
             needs = size
           data_list.extend(self._get_segments(self._offset, needs))
           self._offset += needs
+          self._reset_read_ahead()
           break
 
-        if self._buffer_future:
-          self._buffer.reset(self._buffer_future.get_result())
-          self._buffer_future = None
+        self._next_buffer()
 
-    if self._buffer_future is None:
-      self._request_next_buffer()
+    self._fill_read_ahead()
     return ''.join(data_list)
 
   def _remaining(self):
-    return self._file_size - self._offset
+    return max(self._end - self._offset, 0)
+
+  def _reset_read_ahead(self):
+    """Drop all prefetched segments and shrink the read-ahead to one buffer.
+
+    Requires self._offset and self._buffer are in consistent state.
+    """
+    self._buffer_futures = collections.deque()
+    self._next_offset = self._offset + self._buffer.remaining()
+    self._in_flight = 0
+    self._read_ahead = self._buffer_size
+    self._segments_read = 0
+
+  def _next_buffer(self):
+    """Make the oldest prefetched segment the current buffer.
+
+    Reading on into a prefetched segment means the file is read sequentially,
+    so the read-ahead grows. The caller requests the next segments, a large
+    read first consumes all segments in flight and fetches the rest at once.
+    """
+    future, request_size = self._buffer_futures.popleft()
+    self._in_flight -= request_size
+    self._buffer.reset(future.get_result())
+    self._segments_read += 1
+    if self._segments_read > 1:
+      # The first segment after a seek is no proof of sequential reading.
+      self._read_ahead = min(self._read_ahead * 2, self._max_read_ahead)
 
-  def _request_next_buffer(self):
-    """Request next buffer.
+  def _fill_read_ahead(self):
+    """Request segments until the read-ahead is in flight.
 
     Requires self._offset and self._buffer are in consistent state.
     """
-    self._buffer_future = None
-    next_offset = self._offset + self._buffer.remaining()
-    if next_offset != self._file_size:
-      self._buffer_future = self._get_segment(next_offset,
-                                              self._buffer_size)
+    segments = self._read_ahead // self._buffer_size
+    segments = max(1, min(segments, self.MAX_SEGMENTS_IN_FLIGHT))
+    segment_size = min(self._read_ahead // segments, self._max_request_size)
+    while self._in_flight < self._read_ahead and self._next_offset < self._end:
+      request_size = min(segment_size, self._end - self._next_offset)
+      self._buffer_futures.append(
+          (self._get_segment(self._next_offset, request_size), request_size))
+      self._next_offset += request_size
+      self._in_flight += request_size
 
   def _get_segments(self, start, request_size):
     """Get segments of the file from Google Storage as a list.
@@ -469,14 +642,16 @@ class ReadBuffer(object):
       of the file.
       Otherwise, a tuple. The first element is the unverified file segment.
       The second element is a closure that checks response. Caller should
-      first invoke the closure before consuing the file segment.
+      first invoke the closure before consuing the file segment. The third
+      and fourth elements are the status and headers of the response.
 
     Raises:
       ValueError: if the file has changed while reading.
     """
     end = start + request_size - 1
     content_range = '%d-%d' % (start, end)
-    headers = {'Range': 'bytes=' + content_range}
+    headers = self._conditions()
+    headers['Range'] = 'bytes=' + content_range
     status, resp_headers, content = yield self._api.get_object_async(
         self._path, headers=headers)
     def _checker():
@@ -485,8 +660,17 @@ class ReadBuffer(object):
       self._check_etag(resp_headers.get('etag'))
     if check_response:
       _checker()
+      if status == 200:
+        # The range was ignored and the whole file returned.
+        content = content[start:start + request_size]
       raise ndb.Return(content)
-    raise ndb.Return(content, _checker)
+    raise ndb.Return(content, _checker, status, resp_headers)
+
+  def _conditions(self):
+    """Headers that make a request fail if the object was overwritten."""
+    if self._generation is None:
+      return {}
+    return {'x-goog-if-generation-match': str(self._generation)}
 
   def _check_etag(self, etag):
     """Check if etag is the same across requests to GCS.
@@ -494,8 +678,8 @@ class ReadBuffer(object):
     If self._etag is None, set it. If etag is set, check that the new
     etag equals the old one.
 
-    In the __init__ method, we fire one HEAD and one GET request using
-    ndb tasklet. One of them would return first and set the first value.
+    In the __init__ method, the first GET request sets the first value. A HEAD
+    request only follows when that response does not report the file size.
 
     Args:
       etag: etag from a GCS HTTP response. None if etag is not part of the
@@ -515,7 +699,7 @@ class ReadBuffer(object):
   def close(self):
     self.closed = True
     self._buffer = None
-    self._buffer_future = None
+    self._buffer_futures = None
 
   def __enter__(self):
     return self
@@ -528,6 +712,7 @@ class ReadBuffer(object):
     """Set the file's current offset.
 
     Note if the new offset is out of bound, it is adjusted to either 0 or EOF.
+    When the buffer was opened with a length, EOF is at offset + length.
 
     Args:
       offset: seek offset as number.
@@ -541,22 +726,26 @@ class ReadBuffer(object):
     """
     self._check_open()
 
-    self._buffer.reset()
-    self._buffer_future = None
-
     if whence == os.SEEK_SET:
-      self._offset = offset
+      new_offset = offset
     elif whence == os.SEEK_CUR:
-      self._offset += offset
+      new_offset = self._offset + offset
     elif whence == os.SEEK_END:
-      self._offset = self._file_size + offset
+      new_offset = self._file_size + offset
     else:
       raise ValueError('Whence mode %s is invalid.' % str(whence))
 
-    self._offset = min(self._offset, self._file_size)
-    self._offset = max(self._offset, 0)
+    new_offset = min(new_offset, self._end)
+    new_offset = max(new_offset, 0)
+    if new_offset == self._offset:
+      # Sequential reading continues, keep what was prefetched.
+      return
+
+    self._offset = new_offset
+    self._buffer.reset()
+    self._reset_read_ahead()
     if self._remaining():
-      self._request_next_buffer()
+      self._fill_read_ahead()
 
   def tell(self):
     """Tell the file's current offset.
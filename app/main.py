@@ -14,15 +14,89 @@
 
 import webapp2
 import mimetypes
+import posixpath
 import re
+import json
+import uuid
+import calendar
 import cloudstorage
+from email.utils import parsedate_tz, mktime_tz
+from webob.etag import NoETag
 from urlparse import urlparse
+from google.appengine.api import lib_config
+from cache import ObjectCache, LookupCache
 #import google.cloud
 
+# Hot objects are kept in memory, see ObjectCache
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+CACHE_MAX_OBJECT_BYTES = 1024 * 1024
+# Seconds an object is served from memory before it is checked against storage again
+CACHE_TTL = 30
+
+objectCache = ObjectCache(CACHE_MAX_BYTES, CACHE_MAX_OBJECT_BYTES, CACHE_TTL)
+
+# Objects known to be missing, bots probing nonexistent URLs cost no storage requests
+MISSING_MAX_ENTRIES = 4096
+MISSING_TTL = 10
+
+missingObjects = LookupCache(MISSING_MAX_ENTRIES, MISSING_TTL)
+
+# Extension-less paths -> the object they resolved to, either their index.html or themselves
+RESOLVED_MAX_ENTRIES = 4096
+RESOLVED_TTL = CACHE_TTL
+
+resolvedPaths = LookupCache(RESOLVED_MAX_ENTRIES, RESOLVED_TTL)
+
+# Objects too large for the object cache are streamed in chunks of this size
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Used for objects uploaded without a Cache-Control of their own
+DEFAULT_CACHE_CONTROL = "public, max-age=3600"
+
+# A Range header asking for more ranges than this is ignored
+MAX_RANGES = 16
+RANGE_PATTERN = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+# Precompressed variants stored by the sync tool under VARIANT_PREFIX/<encoding>/<object name>,
+# the original object lists their encodings in its x-goog-meta-encodings metadata
+VARIANT_PREFIX = ".cdn-sync/variants/"
+PREFERRED_ENCODINGS = ["br", "gzip"]
+
+# Project specific content types, set cdn_CONTENT_TYPES in appengine_config.py
+# e.g. cdn_CONTENT_TYPES = {'.webmanifest': 'application/manifest+json'}
+# Set cdn_HEDGE_REQUESTS = True to duplicate slow storage reads, see cloudstorage.HedgePolicy.
+# Off by default: the ndb event loop cannot hedge a stat or read that is the only request
+# in flight, only the concurrent segments of streamed objects benefit.
+config = lib_config.register('cdn', {'CONTENT_TYPES': {}, 'HEDGE_REQUESTS': False})
+
+if config.HEDGE_REQUESTS:
+	cloudstorage.set_hedge_policy(cloudstorage.HedgePolicy())
+
+HAS_EXTENSION_PATTERN = re.compile("^.+\.([a-zA-Z0-9])*$")
+
+def buildContentTypes():
+	"""
+	Returns the lowercase extension -> content type table, built once per instance.
+	"""
+	# Compression extensions like .gz depend on the extension before them, see getContentType.
+	contentTypes = dict((extension.lower(), contentType)
+		for (extension, contentType) in mimeTypes.types_map[True].items()
+		if extension not in mimeTypes.encodings_map and extension not in mimeTypes.suffix_map)
+	contentTypes['.css'] = "text/css"
+	contentTypes.update((extension.lower(), contentType)
+		for (extension, contentType) in config.CONTENT_TYPES.items())
+	return contentTypes
+
+mimeTypes = mimetypes.MimeTypes()
+contentTypes = buildContentTypes()
+
 def getContentType(filename):
-	if filename.lower().endswith('.css'):
-		return "text/css"
-	return mimetypes.MimeTypes().guess_type(filename)[0]
+	(_, extension) = posixpath.splitext(filename)
+	contentType = contentTypes.get(extension.lower())
+	if contentType is None:
+		# Unknown or compound extensions like .tar.gz
+		contentType = mimeTypes.guess_type(filename)[0]
+	return contentType
 
 # https://stackoverflow.com/questions/8567171/how-do-i-remove-a-query-from-a-url
 def filterURL(filename):
@@ -30,6 +104,164 @@ def filterURL(filename):
 	url_without_query_string = o.path[1:]
 	return url_without_query_string
 
+def statObject(filename):
+	"""
+	Returns a tuple (GCSFileStat, contents) of a GCS object. The contents come from the
+	object cache when it is still current, otherwise they are None and not read yet.
+	Raises cloudstorage.NotFoundError when the object does not exist.
+	"""
+	entry = objectCache.get(filename)
+	if entry is not None and objectCache.isFresh(entry):
+		return (entry.fileStat, entry.content)
+
+	if missingObjects.get(filename):
+		raise cloudstorage.NotFoundError("Known to be missing: %s" % filename)
+
+	try:
+		fileStat = cloudstorage.stat(filename)
+	except cloudstorage.NotFoundError:
+		objectCache.invalidate(filename)
+		missingObjects.put(filename, True)
+		raise
+
+	if entry is not None and objectCache.revalidate(entry, fileStat):
+		return (entry.fileStat, entry.content)
+	return (fileStat, None)
+
+def readObject(filename, fileStat):
+	"""
+	Returns the contents of a GCS object at the version of fileStat and caches them.
+	Raises cloudstorage.PreconditionFailedError when the object changed since the stat.
+	"""
+	with cloudstorage.open(filename, generation=fileStat.generation) as gcs_file:
+		content = gcs_file.read()
+
+	objectCache.put(filename, content, fileStat)
+	return content
+
+def variantName(filename, encoding):
+	"""
+	Returns the GCS filename of the variant of an object compressed with encoding.
+	"""
+	(_, bucket, objectName) = filename.split("/", 2)
+	return "/%s/%s%s/%s" % (bucket, VARIANT_PREFIX, encoding, objectName)
+
+def objectMetadata(fileStat):
+	return dict((key.lower(), value) for (key, value) in (fileStat.metadata or {}).items())
+
+def chooseEncoding(available, acceptEncoding):
+	"""
+	Returns the most preferred of the available encodings allowed by an Accept-Encoding
+	header, None when the client accepts none of them.
+	"""
+	if not acceptEncoding:
+		return None
+
+	accepted = {}
+	for item in acceptEncoding.split(","):
+		(coding, _, params) = item.partition(";")
+		quality = 1.0
+		params = params.replace(" ", "")
+		if params.startswith("q="):
+			try:
+				quality = float(params[2:])
+			except ValueError:
+				quality = 0.0
+		accepted[coding.strip().lower()] = quality
+
+	for encoding in PREFERRED_ENCODINGS:
+		if encoding in available and accepted.get(encoding, accepted.get("*", 0)) > 0:
+			return encoding
+	return None
+
+def invalidateObject(filename):
+	"""
+	Forgets everything cached about a GCS object, including the paths resolving to it.
+	"""
+	objectCache.invalidate(filename)
+	missingObjects.invalidate(filename)
+	resolvedPaths.invalidate(filename)
+	if filename.endswith("/index.html"):
+		directory = filename[:-len("index.html")]
+		resolvedPaths.invalidate(directory)
+		resolvedPaths.invalidate(directory[:-1])
+
+def openRange(filename, fileStat, start, end):
+	"""
+	Opens the bytes [start, end) of a GCS object at the version of fileStat. The first
+	chunk is requested right away, so a changed object fails before any header is sent.
+	Raises cloudstorage.PreconditionFailedError when the object changed since the stat.
+	"""
+	return cloudstorage.open(filename, offset=start, length=end - start,
+		read_buffer_size=STREAM_CHUNK_SIZE, generation=fileStat.generation)
+
+def streamFile(gcs_file):
+	"""
+	Yields the contents of an opened GCS file in chunks of STREAM_CHUNK_SIZE bytes.
+	The read buffer prefetches the next chunk while the current one is written, and
+	never fetches beyond the end of the range.
+	"""
+	with gcs_file:
+		chunk = gcs_file.read(STREAM_CHUNK_SIZE)
+		while chunk:
+			yield chunk
+			chunk = gcs_file.read(STREAM_CHUNK_SIZE)
+
+def streamRange(filename, fileStat, start, end):
+	"""
+	Like streamFile, but the range is only opened once the first chunk is wanted.
+	Every read is pinned to the version of fileStat: when the object is overwritten
+	meanwhile the response is cut short instead of mixing both versions.
+	"""
+	for chunk in streamFile(openRange(filename, fileStat, start, end)):
+		yield chunk
+
+def streamMultipart(parts, closing):
+	for (header, chunks) in parts:
+		yield header
+		for chunk in chunks:
+			yield chunk
+		yield "\r\n"
+	yield closing
+
+def parseRanges(header, size):
+	"""
+	Returns the satisfiable byte ranges of a Range header as (start, end) tuples, the end
+	is exclusive. None when there is no valid header, the whole object is sent then.
+	An empty list when none of the ranges can be satisfied.
+	"""
+	if not header:
+		return None
+	(unit, _, specs) = header.partition("=")
+	if unit.strip().lower() != "bytes":
+		return None
+	specs = [spec for spec in specs.split(",") if spec.strip()]
+	if not specs or len(specs) > MAX_RANGES:
+		return None
+
+	ranges = []
+	for spec in specs:
+		match = RANGE_PATTERN.match(spec)
+		if match is None:
+			return None
+
+		(first, last) = match.groups()
+		if first:
+			start = int(first)
+			end = int(last) + 1 if last else size
+			if last and end <= start:
+				return None
+			if start < size:
+				ranges.append((start, min(end, size)))
+		elif last:
+			# Suffix range, the last bytes of the object
+			length = int(last)
+			if length > 0 and size > 0:
+				ranges.append((max(size - length, 0), size))
+		else:
+			return None
+	return ranges
+
 class ContentServerGAE(webapp2.RequestHandler):
 	BUCKET_NAME = "labo-cdn.appspot.com"
 
@@ -37,43 +269,198 @@ class ContentServerGAE(webapp2.RequestHandler):
 		# We add a 'valid' domain to be able to use this library, kind of hackish but it works
 		filename = filterURL("http://example.com/" + filename)
 		filename = "/" + self.BUCKET_NAME + "/" + filename
-		self.__hasExtenstionPattern = re.compile("^.+\.([a-zA-Z0-9])*$")
-		content = ""
 		contentType = getContentType(filename)
 
-		if not self.__hasExtenstionPattern.match(filename):
+		resolved = resolvedPaths.get(filename)
+		if resolved is not None:
+			try:
+				self.sendObject(resolved, getContentType(resolved))
+				return
+
+			except cloudstorage.NotFoundError:
+				resolvedPaths.invalidate(filename)
+
+		hasExtension = HAS_EXTENSION_PATTERN.match(filename)
+		if not hasExtension:
 			filenameIndexed = filename[:]
 			if not filenameIndexed.endswith("/"):
 				filenameIndexed = filenameIndexed + "/"
 
 			filenameIndexed = filenameIndexed + "index.html"
 			try:
-				with cloudstorage.open(filenameIndexed) as gcs_file:
-					content = content + gcs_file.read()
-
-				contentType = getContentType(filenameIndexed)
-				self.sendResponse(content, contentType)
+				self.sendObject(filenameIndexed, getContentType(filenameIndexed))
+				resolvedPaths.put(filename, filenameIndexed)
 				return 
 
 			except cloudstorage.NotFoundError:
 				pass
 		
 		try:
-			with cloudstorage.open(filename) as gcs_file:
-				content = content + gcs_file.read()
-
-			self.sendResponse(content, contentType)
+			self.sendObject(filename, contentType)
+			if not hasExtension:
+				resolvedPaths.put(filename, filename)
 
 		except cloudstorage.NotFoundError:
 			self.abort(404)
 			pass
 
-	def sendResponse(self, output, contentType):
+	def sendObject(self, filename, contentType):
+		try:
+			self.sendVersion(filename, contentType)
+		except cloudstorage.PreconditionFailedError:
+			# Overwritten between the stat and the first read, nothing is sent yet.
+			# The headers of the old version are replaced by the second attempt.
+			self.response.status = 200
+			self.response.headers.pop('Vary', None)
+			self.response.headers.pop('Content-Encoding', None)
+			self.sendVersion(filename, contentType)
+
+	def sendVersion(self, filename, contentType):
+		"""
+		Sends the version of the object found by its stat. Raises
+		cloudstorage.PreconditionFailedError when it changed before its body was opened.
+		"""
+		(fileStat, content) = statObject(filename)
+
+		encodings = objectMetadata(fileStat).get('x-goog-meta-encodings')
+		if encodings:
+			# The response depends on the encodings the client accepts.
+			self.response.headers['Vary'] = "Accept-Encoding"
+			encoding = chooseEncoding(encodings.split(","), self.request.headers.get('Accept-Encoding'))
+			if encoding is not None:
+				try:
+					variant = variantName(filename, encoding)
+					(fileStat, content) = statObject(variant)
+					filename = variant
+					self.response.headers['Content-Encoding'] = encoding
+				except cloudstorage.NotFoundError:
+					# Removed in the meantime, the original always does.
+					pass
+
+		self.response.headers['ETag'] = '"%s"' % fileStat.etag
+		self.response.last_modified = int(fileStat.st_ctime)
+		metadata = objectMetadata(fileStat)
+		self.response.headers['Cache-Control'] = metadata.get('cache-control', DEFAULT_CACHE_CONTROL)
+		self.response.headers['Accept-Ranges'] = "bytes"
+
+		if self.isNotModified(fileStat):
+			# The client already has this version, the body is not even read.
+			self.response.status = 304
+			return
+
+		ranges = None
+		if self.isRangeCurrent(fileStat):
+			ranges = parseRanges(self.request.headers.get('Range'), fileStat.st_size)
+
+		if ranges is None:
+			if content is None and fileStat.st_size > objectCache.maxObjectBytes:
+				gcs_file = openRange(filename, fileStat, 0, fileStat.st_size)
+				self.sendResponse(streamFile(gcs_file), contentType, fileStat.st_size)
+				return
+			if content is None:
+				content = readObject(filename, fileStat)
+			self.sendResponse(content, contentType)
+		elif not ranges:
+			self.response.status = 416
+			self.response.headers['Content-Range'] = "bytes */%d" % fileStat.st_size
+		else:
+			self.sendRanges(filename, content, ranges, fileStat, contentType)
+
+	def sendRanges(self, filename, content, ranges, fileStat, contentType):
+		size = fileStat.st_size
+		parts = []
+		for (start, end) in ranges:
+			if content is not None:
+				parts.append([content[start:end]])
+			elif not parts:
+				# Opened before the 206 is sent, a changed object is served again from a new stat.
+				parts.append(streamFile(openRange(filename, fileStat, start, end)))
+			else:
+				# Each further range is only opened once the previous one is written. All reads
+				# are pinned to the same generation, an overwrite aborts the response instead.
+				parts.append(streamRange(filename, fileStat, start, end))
+
+		self.response.status = 206
+		if len(ranges) == 1:
+			(start, end) = ranges[0]
+			self.response.headers['Content-Range'] = "bytes %d-%d/%d" % (start, end - 1, size)
+			self.sendResponse(parts[0], contentType, end - start)
+			return
+
+		boundary = uuid.uuid4().hex
+		headers = ["--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+			% (boundary, contentType or "application/octet-stream", start, end - 1, size)
+			for (start, end) in ranges]
+		closing = "--%s--\r\n" % boundary
+		length = sum(len(header) + end - start + 2 for (header, (start, end)) in zip(headers, ranges)) + len(closing)
+		self.sendResponse(streamMultipart(zip(headers, parts), closing),
+			"multipart/byteranges; boundary=" + boundary, length)
+
+	def isRangeCurrent(self, fileStat):
+		# With If-Range the client only wants the ranges of the version it already has.
+		ifRange = self.request.headers.get('If-Range')
+		if not ifRange:
+			return True
+		if ifRange.startswith('"') or ifRange.startswith('W/'):
+			return ifRange == '"%s"' % fileStat.etag
+
+		modified = parsedate_tz(ifRange)
+		return modified is not None and mktime_tz(modified) == int(fileStat.st_ctime)
+
+	def isNotModified(self, fileStat):
+		# If-None-Match takes precedence, If-Modified-Since is only for clients without an etag.
+		# An If-None-Match of * evaluates as false, but still matches every etag.
+		if self.request.if_none_match is not NoETag:
+			return fileStat.etag in self.request.if_none_match
+
+		modifiedSince = self.request.if_modified_since
+		if modifiedSince is None:
+			return False
+		return int(fileStat.st_ctime) <= calendar.timegm(modifiedSince.utctimetuple())
+
+	def sendResponse(self, output, contentType, length=None):
+		"""
+		Writes output as the response body. With a length, output is an iterable of chunks
+		which are only read from storage while the response is written.
+		"""
 		self.response.headers['Content-Type'] = contentType
 		if contentType is "application/pdf":
 			self.response.headers['Content-Disposition'] = "inline"
 		
-		self.response.write(output)
+		if length is None:
+			self.response.write(output)
+		else:
+			self.response.app_iter = output
+			self.response.content_length = length
+
+class CacheStats(webapp2.RequestHandler):
+	def get(self):
+		stats = {
+			'objects': objectCache.stats(),
+			'missing': missingObjects.stats(),
+			'resolved': resolvedPaths.stats(),
+			'retries': cloudstorage.get_retry_stats(),
+		}
+		hedgePolicy = cloudstorage.get_hedge_policy()
+		if hedgePolicy is not None:
+			stats['hedging'] = hedgePolicy.stats()
+		self.response.headers['Content-Type'] = "application/json"
+		self.response.write(json.dumps(stats, sort_keys=True))
+
+class CacheInvalidation(webapp2.RequestHandler):
+	def post(self):
+		"""
+		Forgets the cached state of the object at `path`, or of all objects without it.
+		"""
+		path = self.request.get('path')
+		if path:
+			invalidateObject("/" + ContentServerGAE.BUCKET_NAME + "/" + path.lstrip("/"))
+		else:
+			objectCache.clear()
+			missingObjects.clear()
+			resolvedPaths.clear()
+
+		self.response.status = 204
 
 """
 class ContentServerGC(webapp2.RequestHandler):
@@ -121,5 +508,7 @@ class ContentServerGC(webapp2.RequestHandler):
 """
 
 app = webapp2.WSGIApplication([
+	webapp2.Route(r'/_cdn/cache', handler=CacheStats),
+	webapp2.Route(r'/_cdn/invalidate', handler=CacheInvalidation),
 	webapp2.Route(r'/<:.*>', handler=ContentServerGAE),
 ], debug=True)
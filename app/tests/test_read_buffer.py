@@ -0,0 +1,99 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from google.appengine.ext import ndb
+from cloudstorage import errors
+from cloudstorage import storage_api
+
+def completed(result):
+	future = ndb.Future()
+	future.set_result(result)
+	return future
+
+class FullBodyApi(object):
+	"""
+	Storage API ignoring the Range header, every GET returns the whole object with a 200.
+	"""
+	def __init__(self, content):
+		self.content = content
+		self.requests = 0
+
+	def get_object_async(self, path, headers=None):
+		self.requests += 1
+		headers = {'etag': '"etag"', 'x-goog-stored-content-length': str(len(self.content))}
+		return completed((200, headers, self.content))
+
+	def head_object(self, path, headers=None):
+		raise AssertionError("The size is known from the GET")
+
+class FullBodyReadTest(unittest.TestCase):
+	CONTENT = '0123456789'
+
+	def testReadsOnlyTheWindow(self):
+		api = FullBodyApi(self.CONTENT)
+		readBuffer = storage_api.ReadBuffer(api, '/bucket/object', offset=3, length=4)
+
+		self.assertEqual(readBuffer.read(), '3456')
+		self.assertEqual(readBuffer.read(), '')
+
+	def testPrefetchedSegmentsOnlyHoldTheWindow(self):
+		api = FullBodyApi(self.CONTENT)
+		readBuffer = storage_api.ReadBuffer(api, '/bucket/object', buffer_size=2, offset=3, length=5)
+
+		self.assertEqual(readBuffer.read(), '34567')
+		self.assertEqual(api.requests, 3)
+
+	def testReadsTheWholeObject(self):
+		readBuffer = storage_api.ReadBuffer(FullBodyApi(self.CONTENT), '/bucket/object')
+
+		self.assertEqual(readBuffer.read(), self.CONTENT)
+
+class GenerationApi(object):
+	"""
+	Storage API holding one version of an object, conditional requests at another
+	generation fail with a 412.
+	"""
+	def __init__(self, content, generation):
+		self.content = content
+		self.generation = generation
+		self.conditions = []
+
+	def get_object_async(self, path, headers=None):
+		condition = headers.get('x-goog-if-generation-match')
+		self.conditions.append(condition)
+		if condition is not None and condition != str(self.generation):
+			return completed((412, {}, ''))
+		(start, end) = [int(bound) for bound in headers['Range'][len('bytes='):].split('-')]
+		headers = {'etag': '"etag"', 'content-range': 'bytes %d-%d/%d' % (start, end, len(self.content))}
+		return completed((206, headers, self.content[start:end + 1]))
+
+class GenerationReadTest(unittest.TestCase):
+	CONTENT = '0123456789'
+
+	def testEveryRequestIsConditional(self):
+		api = GenerationApi(self.CONTENT, 7)
+		readBuffer = storage_api.ReadBuffer(api, '/bucket/object', buffer_size=4, generation=7)
+
+		self.assertEqual(readBuffer.read(), self.CONTENT)
+		self.assertEqual(set(api.conditions), set(['7']))
+
+	def testOpeningAnotherGenerationFails(self):
+		api = GenerationApi(self.CONTENT, 8)
+
+		self.assertRaises(errors.PreconditionFailedError,
+			storage_api.ReadBuffer, api, '/bucket/object', generation=7)
+
+	def testOverwriteWhileReadingFails(self):
+		api = GenerationApi(self.CONTENT, 7)
+		readBuffer = storage_api.ReadBuffer(api, '/bucket/object', buffer_size=2,
+			max_read_ahead=2, generation=7)
+		self.assertEqual(readBuffer.read(2), '01')
+
+		api.generation = 8
+		self.assertRaises(errors.PreconditionFailedError, readBuffer.read)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,54 @@
+"""
+Measures HTMLHandler.process_file on generated single line HTML pages.
+
+Run from the sync directory: python bench/bench_html_links.py [sizes in MB...]
+
+Prints the throughput and the peak traced memory per page size. Check out an
+older revision of processors/html_handling.py to compare against it.
+"""
+import io
+import logging
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from processors.html_handling import HTMLHandler
+
+def generate_page(size):
+    """
+    Returns minified HTML of at least size bytes, without a single line break.
+    """
+    parts = []
+    length = 0
+    while length < size:
+        part = ('<div class="c%d"><a href="page%d.html">link</a><img src="img/%d.png" alt="x"><p>%s</p></div>'
+                % (length, length, length, 'lorem ipsum ' * 20))
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts).encode()
+
+def measure(handler, page_path, data):
+    tracemalloc.start()
+    start = time.perf_counter()
+    handler.process_file(io.BytesIO(data), page_path, ('text/html', None))
+    elapsed = time.perf_counter() - start
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (elapsed, peak)
+
+def main(sizes):
+    logging.basicConfig(level=logging.ERROR)
+    watch_path = pathlib.Path(tempfile.mkdtemp()).resolve()
+    handler = HTMLHandler(logging.getLogger('bench'), watch_path)
+
+    for size in sizes:
+        data = generate_page(size * 1024 * 1024)
+        (elapsed, peak) = measure(handler, watch_path / 'index.html', data)
+        print("%3d MB: %.2fs, %5.1f MB/s, peak %.1f MB" % (size, elapsed, size / elapsed, peak / 1e6))
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [1, 4, 16])
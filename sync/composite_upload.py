@@ -0,0 +1,91 @@
+import math
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import storage
+from google.cloud.exceptions import GoogleCloudError
+
+class CompositeUploader:
+    """
+    Uploads very large files as separate parts over parallel connections.
+
+    The cloud composes the parts into the final object, after which the temporary
+    part objects are removed again. Parts are private and live under PART_PREFIX,
+    where reconciliation removes the ones left behind by a crash.
+    """
+    # The cloud composes at most this many objects in one request.
+    MAX_COMPONENTS = 32
+    # Outside of every namespace, see UploadHandler.RESERVED_DIRECTORY.
+    PART_PREFIX = '.cdn-sync/parts/'
+    # Up to this size a part is uploaded in one request, above it in a resumable session.
+    MULTIPART_LIMIT = 8 * 1024 * 1024
+    # Chunk size of the resumable part uploads, one request per chunk.
+    CHUNK_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, logger, bucket, threshold, part_size, parallelism):
+        self.logger = logger.getChild('Composite')
+        self.bucket = bucket
+
+        assert part_size > 0, 'The part size MUST be positive!'
+        assert parallelism > 0, 'At least one part must be uploaded at a time!'
+        self.threshold = threshold
+        self.part_size = part_size
+        self.parallelism = parallelism
+
+    def upload(self, blob, file_path, file_size):
+        """
+        Uploads the file into the given blob. The blob properties are updated
+        with the composed object returned by the cloud.
+
+        Returns the amount of requests sent to the cloud.
+        """
+        part_size = max(self.part_size, math.ceil(file_size / self.MAX_COMPONENTS))
+        part_count = math.ceil(file_size / part_size)
+        # Unique per upload, concurrent uploads of the same file never share parts.
+        token = uuid.uuid4().hex
+        parts = [storage.Blob("%s%s.part-%s-%02d" % (self.PART_PREFIX, blob.name, token, index), self.bucket,
+                              chunk_size=self.CHUNK_SIZE)
+                 for index in range(part_count)]
+
+        self.logger.info("Uploading `%s` in %d parts of %d bytes", blob.name, part_count, part_size)
+        request_count = 0
+        try:
+            with ThreadPoolExecutor(self.parallelism) as executor:
+                uploads = [executor.submit(self._upload_part, part, file_path, index * part_size,
+                                           min(part_size, file_size - index * part_size))
+                           for (index, part) in enumerate(parts)]
+                for upload in uploads:
+                    request_count += upload.result()
+
+            blob.compose(parts)
+            request_count += 1
+        finally:
+            request_count += self._remove_parts(parts)
+
+        return request_count
+
+    def _upload_part(self, part, file_path, offset, length):
+        """
+        Returns the amount of requests sent for the part.
+        """
+        # Every part reads through its own file handle.
+        with open(file_path.as_posix(), 'rb') as part_stream:
+            part_stream.seek(offset)
+            part.upload_from_file(part_stream, size=length, predefined_acl='private')
+        if length <= self.MULTIPART_LIMIT:
+            return 1
+        # Starting the session, then every chunk.
+        return 1 + math.ceil(length / self.CHUNK_SIZE)
+
+    def _remove_parts(self, parts):
+        """
+        Removes the parts in one batch request. Returns the amount of requests sent.
+        """
+        try:
+            with self.bucket.client.batch():
+                for part in parts:
+                    part.delete()
+        except GoogleCloudError:
+            # Every deletion was attempted, parts that were never uploaded are missing.
+            pass
+        return 1
@@ -0,0 +1,100 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    # Optional, without it only gzip variants are stored.
+    brotli = None
+
+class Compressor:
+    """
+    Builds precompressed variants of compressible files.
+
+    A variant is stored under VARIANT_PREFIX and its encoding, followed by the name of
+    the original object. No local file maps there, unlike e.g. a suffix which would
+    collide with a real `.gz` file. The original object lists the encodings of its
+    variants in its metadata, from which the CDN app picks the one the client accepts.
+    """
+    # Outside of every namespace, see UploadHandler.RESERVED_DIRECTORY.
+    VARIANT_PREFIX = '.cdn-sync/variants/'
+    ENCODINGS = ('br', 'gzip')
+    # Besides text/*
+    COMPRESSIBLE_TYPES = {
+        'application/javascript',
+        'application/json',
+        'application/manifest+json',
+        'application/xml',
+        'application/xhtml+xml',
+        'application/rss+xml',
+        'application/atom+xml',
+        'application/wasm',
+        'image/svg+xml',
+        'image/x-icon',
+        'image/vnd.microsoft.icon',
+        'font/ttf',
+        'font/otf',
+    }
+    # A variant is only worth storing when it saves at least this fraction of the size.
+    MIN_SAVING = 0.1
+
+    def __init__(self, logger, min_size=1024, max_size=16 * 1024 * 1024, gzip_level=9, brotli_quality=11):
+        self.logger = logger.getChild('Compressor')
+
+        assert 0 <= min_size <= max_size, 'The minimum size cannot exceed the maximum size!'
+        self.min_size = min_size
+        self.max_size = max_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    @classmethod
+    def variant_name(cls, file_name, encoding):
+        assert encoding in cls.ENCODINGS, 'Unknown encoding!'
+        return cls.VARIANT_PREFIX + encoding + '/' + file_name
+
+    @classmethod
+    def original_name(cls, variant_name):
+        """
+        Returns a tuple (name of the original object, encoding) of a variant name,
+        None when variant_name does not name a variant.
+        """
+        if not variant_name.startswith(cls.VARIANT_PREFIX):
+            return None
+        (encoding, _, file_name) = variant_name[len(cls.VARIANT_PREFIX):].partition('/')
+        if encoding not in cls.ENCODINGS or not file_name:
+            return None
+        return (file_name, encoding)
+
+    def is_compressible(self, type_result):
+        (content_type, encoding) = type_result
+        if encoding or not content_type:
+            # Already compressed, like .gz archives, or unknown.
+            return False
+        return content_type.startswith('text/') or content_type in self.COMPRESSIBLE_TYPES
+
+    def compress(self, file_stream, file_size, type_result):
+        """
+        Returns a dict mapping encodings to the compressed file contents, only for
+        the variants worth storing. The stream is rewound afterwards.
+        """
+        if not self.min_size <= file_size <= self.max_size or not self.is_compressible(type_result):
+            return {}
+
+        file_stream.seek(0)
+        data = file_stream.read()
+        file_stream.seek(0)
+
+        variants = {}
+        for encoding in self.encodings:
+            compressed = self._compress(encoding, data)
+            if len(compressed) <= len(data) * (1 - self.MIN_SAVING):
+                variants[encoding] = compressed
+        self.logger.debug("Compressed %d bytes into %s", len(data),
+                          ", ".join("%s: %d" % (encoding, len(compressed)) for (encoding, compressed) in variants.items()))
+        return variants
+
+    def _compress(self, encoding, data):
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_quality)
+        # A fixed mtime keeps the output, and so its md5, the same for the same input.
+        return gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
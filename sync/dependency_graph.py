@@ -0,0 +1,79 @@
+from state_file import StateFile
+
+class DependencyGraph(StateFile):
+    """
+    Persistent graph of pages and the local files they reference, keyed by CDN name.
+
+    For every reference the size and mtime of the file are kept at the moment it was
+    scheduled for upload. When a page changes only references which are new, or
+    which changed since, have to be scheduled again.
+    """
+    def __init__(self, logger, graph_path, autosave_interval=30):
+        super().__init__(logger.getChild('DependencyGraph'), graph_path, autosave_interval)
+
+        # Reverse edges, file name -> names of the pages referencing it.
+        self.dependents_index = {}
+        for (page_name, references) in self.entries.items():
+            for file_name in references:
+                self.dependents_index.setdefault(file_name, set()).add(page_name)
+
+    @staticmethod
+    def file_fingerprint(file_path):
+        file_stat = file_path.stat()
+        return [file_stat.st_size, file_stat.st_mtime_ns]
+
+    def update_page(self, page_name, references):
+        """
+        Replaces the references of a page.
+
+        references: dict mapping CDN names to the local paths referenced by the page.
+
+        Returns the paths which were added or changed since the page was last seen.
+        """
+        fingerprints = {}
+        for (file_name, file_path) in references.items():
+            try:
+                fingerprints[file_name] = self.file_fingerprint(file_path)
+            except OSError:
+                # Vanished in the meantime, nothing to schedule.
+                continue
+
+        with self.lock:
+            previous = self.entries.get(page_name, {})
+            changed = [references[file_name] for (file_name, fingerprint) in fingerprints.items()
+                       if previous.get(file_name) != fingerprint]
+
+            for file_name in previous.keys() - fingerprints.keys():
+                self._unlink(page_name, file_name)
+            for file_name in fingerprints.keys() - previous.keys():
+                self.dependents_index.setdefault(file_name, set()).add(page_name)
+
+            if fingerprints != previous:
+                self.entries[page_name] = fingerprints
+                self.dirty = True
+
+        return changed
+
+    def remove_page(self, page_name):
+        with self.lock:
+            references = self.entries.pop(page_name, None)
+            if references is None:
+                return
+            for file_name in references:
+                self._unlink(page_name, file_name)
+            self.dirty = True
+
+    def dependents(self, file_name):
+        """
+        Returns the sorted names of the pages referencing the given file.
+        """
+        with self.lock:
+            return sorted(self.dependents_index.get(file_name, ()))
+
+    def _unlink(self, page_name, file_name):
+        pages = self.dependents_index.get(file_name)
+        if pages is None:
+            return
+        pages.discard(page_name)
+        if not pages:
+            del self.dependents_index[file_name]
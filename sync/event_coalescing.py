@@ -0,0 +1,178 @@
+import threading
+import time
+
+class EventCoalescer:
+    """
+    Sits between the filesystem watcher and the upload handler.
+
+    Every change is recorded per (resolved) path and only handed to the upload
+    handler once that path has been quiet for `quiet_window` seconds. A burst of
+    create/modify/move/delete events therefore collapses into one final action.
+    A path that keeps changing, like a growing log file, is handed over at the latest
+    `max_wait` seconds after its first pending event.
+    """
+    UPLOAD = 'upload'
+    REMOVE = 'remove'
+    REMOVE_DIRECTORY = 'remove_directory'
+    MOVE = 'move'
+
+    def __init__(self, logger, upload_handler, quiet_window, max_wait=30):
+        self.logger = logger.getChild('Coalescer')
+        self.condition = threading.Condition()
+        self.flusher = None
+        self.stopping = False
+        # Path -> (action, deadline, source path of a move, latest deadline)
+        self.pending = {}
+        self.received_events = 0
+        self.suppressed_events = 0
+
+        assert upload_handler is not None, 'Upload handler is None!'
+        self.handler = upload_handler
+
+        assert quiet_window >= 0, 'The quiet window cannot be negative!'
+        self.quiet_window = quiet_window
+
+        assert max_wait >= quiet_window, 'The max wait cannot be shorter than the quiet window!'
+        self.max_wait = max_wait
+
+    def start(self):
+        self.flusher = threading.Thread(target=self._flush, name="Coalescer", daemon=True)
+        self.flusher.start()
+
+    def stop(self):
+        """
+        Hands all pending actions to the upload handler, without waiting for
+        their quiet window to pass.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+
+        self.logger.info("Received %d events, %d were suppressed", self.received_events, self.suppressed_events)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'received_events': self.received_events,
+                'suppressed_events': self.suppressed_events,
+                'pending_paths': len(self.pending),
+            }
+
+    def queue_file_upload(self, file_path):
+        self._record(self.UPLOAD, file_path)
+
+    def remove_file(self, file_path):
+        self._record(self.REMOVE, file_path)
+
+    def remove_directory(self, dir_path):
+        self._record(self.REMOVE_DIRECTORY, dir_path)
+
+    def move_file(self, src_path, dest_path):
+        with self.condition:
+            source = self.pending.pop(src_path, None)
+            if source is not None:
+                self.suppressed_events += 1
+
+            if source is None:
+                self._record(self.MOVE, dest_path, src_path)
+            elif source[0] == self.MOVE:
+                if source[2] == dest_path:
+                    # Moved back, the cloud still holds the object under this name.
+                    self._record(self.UPLOAD, dest_path)
+                else:
+                    # Moved twice, the cloud only knows the original source.
+                    self._record(self.MOVE, dest_path, source[2])
+            else:
+                # The cloud does not hold the latest contents of the source.
+                self._record(self.UPLOAD, dest_path)
+                self._record(self.REMOVE, src_path)
+                # Both records stem from one event
+                self.received_events -= 1
+
+    def _record(self, action, file_path, src_path=None):
+        with self.condition:
+            now = time.monotonic()
+            latest_deadline = now + self.max_wait
+            self.received_events += 1
+            previous = self.pending.get(file_path)
+            if previous is not None:
+                # Only the last action for a path matters.
+                self.suppressed_events += 1
+                if previous[0] == self.MOVE and previous[2] != src_path:
+                    # The move is replaced, its source must still disappear from the cloud.
+                    self.pending.setdefault(previous[2], (self.REMOVE, now + self.quiet_window, None, latest_deadline))
+                # Later events never postpone the action beyond the first one's max wait.
+                latest_deadline = previous[3]
+            deadline = min(now + self.quiet_window, latest_deadline)
+            self.pending[file_path] = (action, deadline, src_path, latest_deadline)
+            self.condition.notify()
+
+    def _take_due_actions(self):
+        """
+        Removes and returns the pending actions whose quiet window has passed,
+        ordered by their deadline. MUST be called while holding the condition.
+        """
+        now = time.monotonic()
+        due = [(deadline, path, action, src_path) for (path, (action, deadline, src_path, _)) in self.pending.items()
+               if self.stopping or deadline <= now]
+        for (_, path, _, _) in due:
+            del self.pending[path]
+
+        due.sort(key=lambda item: item[0])
+        return [(path, action, src_path) for (_, path, action, src_path) in due]
+
+    def _dispatch_removals(self, file_paths):
+        """
+        Hands removals to the upload handler, batched per directory. A recursive delete
+        reports every file before its directory, all of them are due at once.
+        """
+        directories = {}
+        for file_path in file_paths:
+            directories.setdefault(file_path.parent, []).append(file_path)
+
+        for batch in directories.values():
+            try:
+                if len(batch) == 1:
+                    self.handler.remove_file(batch[0])
+                else:
+                    self.handler.remove_files(batch)
+            except Exception as error:
+                self.logger.exception(error)
+
+    def _flush(self):
+        while True:
+            with self.condition:
+                due = self._take_due_actions()
+                if not due:
+                    if self.stopping:
+                        return
+                    timeout = None
+                    if self.pending:
+                        next_deadline = min(deadline for (_, deadline, _, _) in self.pending.values())
+                        timeout = max(next_deadline - time.monotonic(), 0)
+                    self.condition.wait(timeout)
+                    continue
+
+            removals = []
+            for (path, action, src_path) in due:
+                if action == self.REMOVE:
+                    removals.append(path)
+                    continue
+                # Keeps the removals in order with the other actions.
+                self._dispatch_removals(removals)
+                removals = []
+                try:
+                    if action == self.UPLOAD:
+                        self.handler.queue_file_upload(path)
+                    elif action == self.MOVE:
+                        self.handler.move_file(src_path, path)
+                    else:
+                        self.handler.remove_directory(path)
+                except Exception as error:
+                    self.logger.exception(error)
+            self._dispatch_removals(removals)
+
+            self.logger.debug("Dispatched %d actions, %d events suppressed so far", len(due), self.suppressed_events)
@@ -10,8 +10,14 @@ import pathlib
 from watchdog.observers import Observer
 
 import watchdog_handling
+from event_coalescing import EventCoalescer
 from processors.html_handling import HTMLHandler
 from upload_handler import UploadHandler
+from manifest import UploadManifest
+from dependency_graph import DependencyGraph
+from resumable_upload import CheckpointStore
+from reconciliation import Reconciler
+from compression import Compressor
 
 def main(logger):
     """
@@ -28,6 +34,32 @@ def main(logger):
                             help="the directory to watch filesystem events for")
     arg_parser.add_argument("-n", "--namespace", type=str, default='',
                             help="the namespace for storing files on the cloud")
+    arg_parser.add_argument("-w", "--upload-workers", type=int, default=4,
+                            help="the amount of files uploaded in parallel")
+    arg_parser.add_argument("-q", "--quiet-window", type=float, default=0.5,
+                            help="seconds a file must stay untouched before it is uploaded")
+    arg_parser.add_argument("--max-wait", type=float, default=30,
+                            help="seconds after which a file that keeps changing is uploaded anyway")
+    arg_parser.add_argument("-s", "--state-dir", type=str, default=os.path.join('~', '.nda-cdn-sync'),
+                            help="the directory to keep the upload manifest and other sync state in")
+    arg_parser.add_argument("--resumable-threshold", type=int, default=32,
+                            help="files of at least this many MiB are uploaded in resumable chunks")
+    arg_parser.add_argument("--resumable-chunk-size", type=int, default=8,
+                            help="the size in MiB of a resumable upload chunk")
+    arg_parser.add_argument("--composite-threshold", type=int, default=256,
+                            help="files of at least this many MiB are uploaded as parallel parts, 0 disables this")
+    arg_parser.add_argument("--composite-part-size", type=int, default=64,
+                            help="the size in MiB of a part of a parallel upload")
+    arg_parser.add_argument("--composite-parallelism", type=int, default=8,
+                            help="the amount of parts of one file uploaded in parallel")
+    arg_parser.add_argument("-c", "--cache-control", type=str, default='public, max-age=3600',
+                            help="the Cache-Control header stored with every uploaded file")
+    arg_parser.add_argument("--no-compression", action='store_true',
+                            help="don't store precompressed gzip/brotli variants of text files")
+    arg_parser.add_argument("-r", "--reconcile", action='store_true',
+                            help="bring the cloud in line with the watch directory before watching it")
+    arg_parser.add_argument("--reconcile-only", action='store_true',
+                            help="bring the cloud in line with the watch directory and exit")
 
     args = arg_parser.parse_args()
 
@@ -38,6 +70,18 @@ def main(logger):
         path = os.getcwd()
 
     namespace = args.namespace
+    bucket_name = 'labo-cdn.appspot.com'
+
+    if args.upload_workers < 1:
+        raise ValueError("At least one upload worker is required")
+    if args.quiet_window < 0:
+        raise ValueError("The quiet window cannot be negative")
+    if args.max_wait < args.quiet_window:
+        raise ValueError("The max wait cannot be shorter than the quiet window")
+    if args.resumable_chunk_size < 1:
+        raise ValueError("The resumable chunk size must be at least 1 MiB")
+    if args.composite_part_size < 1 or args.composite_parallelism < 1:
+        raise ValueError("Parallel uploads need parts of at least 1 MiB and a parallelism of at least 1")
 
     ##############
     # Path processing
@@ -58,9 +102,28 @@ def main(logger):
     #############
     # Handler setup
     ###################
-    upload_handler = UploadHandler(logger, 'labo-cdn.appspot.com', namespace, watchdir_path, processors)
-
-    event_handler = watchdog_handling.FSEventHandler(logger, watchdir_path, upload_handler)
+    # Sync state MUST live outside of the watched directory.
+    state_dir = os.path.abspath(os.path.expanduser(args.state_dir))
+    state_name = "%s-%s" % (bucket_name, namespace.replace('/', '_') or 'default')
+    manifest = UploadManifest(logger, os.path.join(state_dir, "manifest-%s.json" % state_name))
+    dependency_graph = DependencyGraph(logger, os.path.join(state_dir, "graph-%s.json" % state_name))
+    checkpoints = CheckpointStore(logger, os.path.join(state_dir, "checkpoints-%s.json" % state_name))
+    compressor = None if args.no_compression else Compressor(logger)
+
+    upload_handler = UploadHandler(logger, bucket_name, namespace, watchdir_path, processors,
+                                   upload_workers=args.upload_workers, manifest=manifest,
+                                   dependency_graph=dependency_graph, checkpoints=checkpoints,
+                                   resumable_threshold=args.resumable_threshold * 1024 * 1024,
+                                   resumable_chunk_size=args.resumable_chunk_size * 1024 * 1024,
+                                   composite_threshold=args.composite_threshold * 1024 * 1024 or None,
+                                   composite_part_size=args.composite_part_size * 1024 * 1024,
+                                   composite_parallelism=args.composite_parallelism,
+                                   cache_control=args.cache_control or None, compressor=compressor)
+
+    # Collapses bursts of filesystem events before they reach the uploader
+    coalescer = EventCoalescer(logger, upload_handler, args.quiet_window, args.max_wait)
+
+    event_handler = watchdog_handling.FSEventHandler(logger, watchdir_path, coalescer)
     observer = Observer()
     observer.schedule(event_handler, watchdir_path.as_posix(), recursive=True)
 
@@ -89,6 +152,15 @@ def main(logger):
     ##########
     # FS watching 
     ####################
+    upload_handler.start()
+
+    if args.reconcile or args.reconcile_only:
+        Reconciler(logger, upload_handler).run()
+        if args.reconcile_only:
+            upload_handler.stop()
+            return
+
+    coalescer.start()
     observer.start()
     logger.debug("Observer started")
     # Wait until observer has finished.
@@ -102,6 +174,9 @@ def main(logger):
         
         # Await observer cleanup.
         observer.join()
+        # Finish the uploads which were already queued.
+        coalescer.stop()
+        upload_handler.stop()
     except Exception:
         pass
 
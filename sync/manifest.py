@@ -0,0 +1,99 @@
+import base64
+import hashlib
+
+from state_file import StateFile
+
+class UploadManifest(StateFile):
+    """
+    Persistent record of the files pushed to the cloud, keyed by CDN name.
+
+    Every entry holds the size, mtime and md5 hash of the local file at upload
+    time, together with the md5/crc32c hashes reported by the bucket and the
+    encodings of the compressed variants stored next to it. Hashes are stored
+    base64 encoded, the same format the bucket uses.
+    """
+    HASH_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, logger, manifest_path, autosave_interval=30):
+        super().__init__(logger.getChild('Manifest'), manifest_path, autosave_interval)
+
+    @classmethod
+    def hash_file(cls, file_path):
+        """
+        Returns the base64 encoded md5 hash of the file contents.
+        """
+        digest = hashlib.md5()
+        with open(file_path.as_posix(), 'rb') as file_stream:
+            block = file_stream.read(cls.HASH_BLOCK_SIZE)
+            while block:
+                digest.update(block)
+                block = file_stream.read(cls.HASH_BLOCK_SIZE)
+        return base64.b64encode(digest.digest()).decode('ascii')
+
+    def get(self, file_name):
+        with self.lock:
+            entry = self.entries.get(file_name)
+            return dict(entry) if entry else None
+
+    def fingerprint(self, file_name, file_path):
+        """
+        Returns size, mtime and md5 hash of the local file.
+
+        The file is only hashed when its size or mtime differ from the manifest entry.
+        """
+        file_stat = file_path.stat()
+        fingerprint = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns}
+
+        entry = self.get(file_name)
+        if entry and entry['size'] == fingerprint['size'] and entry['mtime'] == fingerprint['mtime']:
+            fingerprint['md5'] = entry['md5']
+        else:
+            fingerprint['md5'] = self.hash_file(file_path)
+        return fingerprint
+
+    def is_current(self, file_name, fingerprint):
+        """
+        True when the cloud already holds the contents described by the fingerprint.
+        """
+        with self.lock:
+            entry = self.entries.get(file_name)
+            if not entry or entry['md5'] != fingerprint['md5']:
+                return False
+
+            if entry['mtime'] != fingerprint['mtime']:
+                # Touched but not changed, remember the new mtime to skip hashing next time.
+                entry['mtime'] = fingerprint['mtime']
+                self.dirty = True
+            return True
+
+    def record_upload(self, file_name, fingerprint, remote_md5, remote_crc32c, encodings=()):
+        with self.lock:
+            self.entries[file_name] = {
+                'size': fingerprint['size'],
+                'mtime': fingerprint['mtime'],
+                'md5': fingerprint['md5'],
+                'remote_md5': remote_md5,
+                'remote_crc32c': remote_crc32c,
+                'encodings': sorted(encodings),
+            }
+            self.dirty = True
+
+    def encodings(self, file_name):
+        """
+        Returns the encodings of the compressed variants uploaded along with the file.
+        """
+        with self.lock:
+            entry = self.entries.get(file_name)
+            return list(entry.get('encodings', ())) if entry else []
+
+    def rename(self, src_name, dest_name):
+        with self.lock:
+            entry = self.entries.pop(src_name, None)
+            if entry is not None:
+                self.entries[dest_name] = entry
+                self.dirty = True
+
+    def forget(self, file_name):
+        with self.lock:
+            if self.entries.pop(file_name, None) is not None:
+                self.dirty = True
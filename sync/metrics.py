@@ -0,0 +1,22 @@
+import collections
+import threading
+
+class Counters:
+    """
+    Thread-safe named counters.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def get(self, name):
+        with self.lock:
+            return self.counts[name]
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
@@ -1,24 +1,82 @@
-import io
-import tempfile
+import re
+import html
 import pathlib
-from urllib.parse import urlparse, urlunparse
-from html.parser import HTMLParser
 
 from .processor import BaseProcessor
 
-class LinkParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.reference_paths = []
+class LinkExtractor:
+    """
+    Pulls the values of href/src attributes out of a binary HTML stream.
+
+    The stream is read in fixed size chunks and only a small tail of each chunk is
+    carried over to the next one, so memory use is bounded no matter how large the
+    file (or a single line of minified HTML) is.
+    """
+    CHUNK_SIZE = 64 * 1024
+    MAX_VALUE_LENGTH = 2048
+    # Attribute name, whitespace and quotes on top of the value.
+    OVERLAP = MAX_VALUE_LENGTH + 64
+    ATTRIBUTE_PATTERN = re.compile(
+        rb'(?<![\w.:-])(?:href|src)\s{0,16}=\s{0,16}'
+        rb'(?:"([^"]{0,%d})"|\'([^\']{0,%d})\'|([^\s"\'<>`=]{1,%d}))' % ((MAX_VALUE_LENGTH,) * 3),
+        re.IGNORECASE)
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+
+    def iter_links(self, file_stream):
+        pending = b''
+        scan_from = 0
+        while True:
+            chunk = file_stream.read(self.chunk_size)
+            data = pending + chunk
+            # A match starting past this limit could continue in the next chunk.
+            limit = len(data) - self.OVERLAP if chunk else len(data)
+
+            next_scan = scan_from
+            for match in self.ATTRIBUTE_PATTERN.finditer(data, scan_from):
+                if match.start() >= limit:
+                    break
+                next_scan = match.end()
+                value = match.group(1) or match.group(2) or match.group(3) or b''
+                value = value.decode('utf-8', 'replace')
+                if '&' in value:
+                    value = html.unescape(value)
+                yield value.strip()
+
+            if not chunk:
+                return
+
+            # Keep one byte in front of the next scan position for the lookbehind.
+            next_scan = max(next_scan, limit)
+            keep_from = max(next_scan - 1, 0)
+            pending = data[keep_from:]
+            scan_from = next_scan - keep_from
+
+# Matches the scheme of an absolute URL, e.g. `https:` or `mailto:`.
+SCHEME_PATTERN = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*:')
+
+def local_link_path(link):
+    """
+    Returns the path part of a link to a local file, None for links pointing elsewhere.
+    """
+    if link.startswith('//'):
+        # Protocol relative link to another host
+        return None
 
-    def handle_starttag(self, tag, attrs):
-        super().handle_starttag(tag, attrs)
+    scheme = SCHEME_PATTERN.match(link)
+    if scheme:
+        if scheme.group(0).lower() != 'file:':
+            return None
+        link = link[scheme.end():]
+        if link.startswith('//'):
+            # Drop the (empty) host part of file://
+            link = link[2:]
+            link = link[link.find('/'):] if '/' in link else ''
 
-        for attr in attrs:
-            (tag, value) = attr
-            if tag in ['href', 'src', 'src']:
-                parse_result = urlparse(value)
-                self.reference_paths.append(parse_result)
+    for separator in ('#', '?'):
+        link = link.split(separator, 1)[0]
+    return link.strip().lstrip('/')
 
 
 class HTMLHandler(BaseProcessor):
@@ -41,52 +99,38 @@ class HTMLHandler(BaseProcessor):
             self.logger.debug("Skipping non-HTML data")
             return (file_stream, None, None)
 
-        # Wrap file stream into text stream.
-        reader = io.BufferedReader(file_stream)
-        wrapper = io.TextIOWrapper(reader)
-
-        # Build temporary file which contains replaced data
-        # temp_file = tempfile.TemporaryFile('w+b')
-
-        # Reset all streams before operations
-        wrapper.seek(0)
+        # Reset stream before operations
+        file_stream.seek(0)
 
-        # Parse all links from the html
-        parser = LinkParser()        
-        next_line = wrapper.readline()
-        while next_line: # String is not empty
-            parser.feed(next_line)
-            next_line = wrapper.readline()
-        
         # Process all links relative to the original path
-        links = parser.reference_paths
         original_containing_path = orig_file_path.parent
         referenced_items = []
-        for link in links:
-            self.logger.debug("Found link `%s`", urlunparse(link))
-            self.logger.debug("%s", link)
-            if not link.scheme or link.scheme == "file":
-                path_str = link.path.strip().lstrip('/')
-                path = pathlib.Path(path_str)
-                if not path.is_absolute():
-                    path = pathlib.Path(original_containing_path, path)
-
-                if not path.exists():
-                    self.logger.warn("No resource found at referenced location `%s`!", path.as_posix())
-                    continue
-
-                # Path MUST be an absolute version!
-                if not self.link_within_watchdir(path):
-                    warn_str = "Link outside watchdir: `%s` \nMove the resource inside the watchdir!"
-                    self.logger.warn(warn_str, path.as_posix())
-                    continue
-                    
-                # Store the path object as a referenced item which must be uploaded as well.
+        seen_paths = set()
+        for link in LinkExtractor().iter_links(file_stream):
+            self.logger.debug("Found link `%s`", link)
+            path_str = local_link_path(link)
+            if not path_str:
+                continue
+
+            path = pathlib.Path(path_str)
+            if not path.is_absolute():
+                path = pathlib.Path(original_containing_path, path)
+
+            if not path.exists():
+                self.logger.warn("No resource found at referenced location `%s`!", path.as_posix())
+                continue
+
+            # Path MUST be an absolute version!
+            if not self.link_within_watchdir(path):
+                warn_str = "Link outside watchdir: `%s` \nMove the resource inside the watchdir!"
+                self.logger.warn(warn_str, path.as_posix())
+                continue
+
+            # Store the path object as a referenced item which must be uploaded as well.
+            if path not in seen_paths:
+                seen_paths.add(path)
                 referenced_items.append(path)
-        
-        # Make sure the stream is not closed after destruction of the reader
-        reader.detach()
+
         # Reset stream to initial position
         file_stream.seek(0)
         return (file_stream, None, referenced_items)
-    
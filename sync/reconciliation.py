@@ -0,0 +1,189 @@
+import datetime
+import os
+import pathlib
+
+from google.cloud.exceptions import GoogleCloudError
+
+from manifest import UploadManifest
+from compression import Compressor
+from composite_upload import CompositeUploader
+
+class Reconciler:
+    """
+    Brings the cloud in line with the watch directory.
+
+    The watch directory is walked and the namespace is listed in the bucket. Files
+    which are missing or differ remotely are queued for upload, objects without a
+    local counterpart are queued for removal. Compressed variants count as part of
+    the file they were made of. The upload handler workers perform
+    these operations in parallel.
+
+    Parts of parallel uploads left behind by a crash are removed as well, so are
+    variants whose original is gone.
+    """
+    # Younger parts may belong to an upload still in progress elsewhere.
+    STALE_PART_AGE = datetime.timedelta(days=1)
+    def __init__(self, logger, upload_handler):
+        self.logger = logger.getChild('Reconciler')
+
+        assert upload_handler is not None, 'Upload handler is None!'
+        self.handler = upload_handler
+
+    def scan_local(self):
+        """
+        Returns a dict mapping CDN names to the local files in the watch directory.
+        """
+        local_files = {}
+        for root, _, files in os.walk(self.handler.watchdir_path.as_posix()):
+            for name in files:
+                file_path = pathlib.Path(root, name)
+                try:
+                    local_files[self.handler.get_cdn_name_exerpt(file_path)] = file_path
+                except ValueError as error:
+                    self.logger.warn("Skipping `%s`: %s", file_path.as_posix(), error)
+        return local_files
+
+    def scan_remote(self):
+        """
+        Returns a dict mapping CDN names to the blobs stored within the namespace.
+        """
+        prefix = self.handler.namespace + '/' if self.handler.namespace else None
+        blobs = self.handler.bucket.list_blobs(prefix=prefix,
+                                               fields='items(name,size,md5Hash,crc32c),nextPageToken')
+        # Without a namespace the reserved directory is listed as well.
+        return {blob.name: blob for blob in blobs if not self.handler.is_reserved_name(blob.name)}
+
+    def scan_variants(self):
+        """
+        Returns the names of the compressed variants stored for the namespace.
+        """
+        namespace_prefix = self.handler.namespace + '/' if self.handler.namespace else ''
+        variant_names = set()
+        for encoding in Compressor.ENCODINGS:
+            prefix = Compressor.variant_name(namespace_prefix, encoding)
+            variant_names.update(blob.name for blob in self.handler.bucket.list_blobs(
+                prefix=prefix, fields='items(name),nextPageToken'))
+        return variant_names
+
+    def remove_stale_parts(self):
+        """
+        Removes the parts of parallel uploads within the namespace which were never
+        composed. Returns the amount of parts removed.
+        """
+        prefix = CompositeUploader.PART_PREFIX + (self.handler.namespace + '/' if self.handler.namespace else '')
+        expired = datetime.datetime.now(datetime.timezone.utc) - self.STALE_PART_AGE
+        names = [blob.name for blob in self.handler.bucket.list_blobs(prefix=prefix,
+                                                                      fields='items(name,timeCreated),nextPageToken')
+                 if blob.time_created is None or blob.time_created < expired]
+        self._delete(names, 'stale parts')
+        return len(names)
+
+    def remove_orphan_variants(self, local_files, remote_variants, removals):
+        """
+        Removes the variants of files which are not in the watch directory, except
+        the ones removed along with their file. Returns the amount of variants removed.
+        """
+        manifest = self.handler.manifest
+        removed_along = set()
+        if manifest is not None:
+            removed_along.update(Compressor.variant_name(file_name, encoding)
+                                 for file_name in removals for encoding in manifest.encodings(file_name))
+
+        names = sorted(variant_name for variant_name in remote_variants
+                       if Compressor.original_name(variant_name)[0] not in local_files
+                       and variant_name not in removed_along)
+        self._delete(names, 'orphaned variants')
+        return len(names)
+
+    def _delete(self, names, description):
+        for start in range(0, len(names), self.handler.BATCH_SIZE):
+            try:
+                with self.handler.client.batch():
+                    for name in names[start:start + self.handler.BATCH_SIZE]:
+                        self.handler.bucket.blob(name).delete()
+            except GoogleCloudError as error:
+                self.logger.error("Not all %s were removed from cloud: %s", description, error)
+
+    def compute_diff(self, local_files, remote_blobs, remote_variants):
+        """
+        Returns a tuple (uploads, removals, unchanged) of CDN name lists.
+        """
+        manifest = self.handler.manifest
+        uploads = []
+        unchanged = []
+        for (file_name, file_path) in local_files.items():
+            blob = remote_blobs.get(file_name)
+            if blob is None or blob.size != file_path.stat().st_size:
+                uploads.append(file_name)
+                continue
+
+            if manifest is not None:
+                fingerprint = manifest.fingerprint(file_name, file_path)
+                local_md5 = fingerprint['md5']
+            else:
+                fingerprint = None
+                local_md5 = UploadManifest.hash_file(file_path)
+
+            if blob.md5_hash is not None:
+                same = blob.md5_hash == local_md5
+            else:
+                # Composite objects carry no md5, only trust a crc32c we uploaded ourselves.
+                entry = manifest.get(file_name) if manifest is not None else None
+                same = (entry is not None and entry['md5'] == local_md5 and
+                        entry['remote_crc32c'] == blob.crc32c)
+
+            if not same:
+                uploads.append(file_name)
+                continue
+
+            if manifest is not None and any(Compressor.variant_name(file_name, encoding) not in remote_variants
+                                            for encoding in manifest.encodings(file_name)):
+                # The file is fine, but the app would look for variants which are gone.
+                uploads.append(file_name)
+                continue
+
+            unchanged.append(file_name)
+            if manifest is not None and not manifest.is_current(file_name, fingerprint):
+                manifest.record_upload(file_name, fingerprint, blob.md5_hash, blob.crc32c)
+
+        removals = [file_name for file_name in remote_blobs if file_name not in local_files]
+        return (uploads, removals, unchanged)
+
+    def run(self):
+        """
+        Queues all differences between the watch directory and the cloud and waits
+        until the upload handler processed them.
+        """
+        self.logger.info("Reconciling `%s` with the cloud", self.handler.watchdir_path.as_posix())
+        local_files = self.scan_local()
+        remote_blobs = self.scan_remote()
+        remote_variants = self.scan_variants()
+        (uploads, removals, unchanged) = self.compute_diff(local_files, remote_blobs, remote_variants)
+
+        if removals and not self.handler.namespace:
+            # Without a namespace the whole bucket was listed, including files
+            # that are not managed by this watch directory.
+            self.logger.warn("Not removing %d remote files, no namespace was provided", len(removals))
+            removals = []
+        if self.handler.namespace:
+            orphan_variants = self.remove_orphan_variants(local_files, remote_variants, removals)
+            if orphan_variants:
+                self.logger.info("Removed %d variants of files which are gone", orphan_variants)
+
+        self.logger.info("Found %d files to upload, %d to remove and %d unchanged",
+                         len(uploads), len(removals), len(unchanged))
+
+        for file_name in uploads:
+            if self.handler.manifest is not None:
+                # The cloud is the truth here, make sure the upload is not skipped.
+                self.handler.manifest.forget(file_name)
+            self.handler.queue_file_upload(local_files[file_name])
+        self.handler.remove_files([self.handler.get_local_path(file_name) for file_name in removals])
+
+        stale_parts = self.remove_stale_parts()
+        if stale_parts:
+            self.logger.info("Removed %d parts of unfinished parallel uploads", stale_parts)
+
+        self.handler.join()
+        self.logger.info("Reconciliation finished")
+        return (uploads, removals, unchanged)
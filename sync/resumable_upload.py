@@ -0,0 +1,206 @@
+import os
+import re
+import threading
+import time
+
+import requests
+
+from state_file import StateFile
+
+class CheckpointStore(StateFile):
+    """
+    Persistent record of the resumable upload sessions in progress, keyed by CDN name.
+
+    Every entry holds the session URI, the amount of bytes committed by the cloud and
+    the size and mtime of the local file the session was started for.
+    """
+    def __init__(self, logger, checkpoint_path):
+        # Checkpoints are written after every chunk, see ResumableUploader.
+        super().__init__(logger.getChild('Checkpoints'), checkpoint_path, autosave_interval=0)
+
+    def get(self, file_name):
+        with self.lock:
+            entry = self.entries.get(file_name)
+            return dict(entry) if entry else None
+
+    def record(self, file_name, session_uri, offset, size, mtime):
+        with self.lock:
+            self.entries[file_name] = {
+                'session_uri': session_uri,
+                'offset': offset,
+                'size': size,
+                'mtime': mtime,
+            }
+            self.dirty = True
+        self.save()
+
+    def forget(self, file_name):
+        with self.lock:
+            if self.entries.pop(file_name, None) is None:
+                return
+            self.dirty = True
+        self.save()
+
+
+class SessionExpiredError(Exception):
+    pass
+
+
+class ResumableUploader:
+    """
+    Uploads large files through a resumable session, in fixed size chunks.
+
+    The session URI and committed offset are checkpointed after every chunk. An
+    upload interrupted by a crash or a network blip continues from the last
+    committed chunk instead of starting over.
+
+    The session URI authorizes the chunks by itself, they are sent over a plain
+    HTTP session.
+    """
+    # The cloud only accepts chunks which are a multiple of this size.
+    CHUNK_GRANULARITY = 256 * 1024
+    RANGE_PATTERN = re.compile(r'bytes=0-(\d+)')
+    # (connect, read) seconds, a stalled connection must not block its worker forever.
+    TIMEOUT = (10, 60)
+
+    def __init__(self, logger, client, checkpoints, threshold, chunk_size, max_retries=5):
+        self.logger = logger.getChild('Resumable')
+        self.client = client
+        self.checkpoints = checkpoints
+
+        assert chunk_size > 0 and chunk_size % self.CHUNK_GRANULARITY == 0, \
+            'The chunk size MUST be a multiple of 256 KiB!'
+        self.chunk_size = chunk_size
+        self.threshold = threshold
+        self.max_retries = max_retries
+        # Sessions are not thread-safe, every upload worker gets its own.
+        self.local = threading.local()
+
+    def upload(self, blob, file_stream, file_name, file_path, predefined_acl=None):
+        """
+        Uploads the stream into the given blob. The blob properties are reloaded
+        from the cloud once the upload is complete.
+
+        Returns the amount of requests sent to the cloud.
+        """
+        file_stream.seek(0, os.SEEK_END)
+        size = file_stream.tell()
+        mtime = file_path.stat().st_mtime_ns
+
+        (session_uri, offset, requests_sent) = self._resume(file_name, size, mtime)
+        if session_uri is None:
+            session_uri = self._start_session(blob, file_name, size, mtime, predefined_acl)
+            requests_sent += 1
+            offset = 0
+
+        retries = 0
+        restarted = False
+        complete = False
+        while not complete:
+            try:
+                requests_sent += 1
+                (offset, complete) = self._send_chunk(session_uri, file_stream, offset, size)
+            except SessionExpiredError:
+                if restarted:
+                    raise
+                # Sessions expire after a week, or are cancelled by the cloud. Only once,
+                # a new session failing the same way points at another problem.
+                restarted = True
+                self.logger.warn("Upload session of `%s` ended, restarting the upload", file_name)
+                session_uri = self._start_session(blob, file_name, size, mtime, predefined_acl)
+                requests_sent += 1
+                offset = 0
+                continue
+            except requests.RequestException as error:
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+                self.logger.warn("Chunk upload of `%s` failed (%s), retrying", file_name, error)
+                time.sleep(min(2 ** retries, 30))
+                try:
+                    requests_sent += 1
+                    # The cloud decides what was committed before the failure.
+                    (offset, complete) = self._query_offset(session_uri, size)
+                except (SessionExpiredError, requests.RequestException):
+                    # Resend from the last known offset, an ended session is restarted then.
+                    pass
+                continue
+
+            retries = 0
+            self.checkpoints.record(file_name, session_uri, offset, size, mtime)
+            self.logger.debug("Committed %d of %d bytes of `%s`", offset, size, file_name)
+
+        self.checkpoints.forget(file_name)
+        # The blob properties, like its md5 hash, are only known to the cloud.
+        blob.reload()
+        requests_sent += 1
+        return requests_sent
+
+    def _start_session(self, blob, file_name, size, mtime, predefined_acl):
+        """
+        Starts a new resumable session and replaces the checkpoint of file_name with it.
+        """
+        # The blob metadata and ACL are sent along when starting the session.
+        session_uri = blob.create_resumable_upload_session(size=size, client=self.client,
+                                                           predefined_acl=predefined_acl)
+        self.checkpoints.record(file_name, session_uri, 0, size, mtime)
+        return session_uri
+
+    def _resume(self, file_name, size, mtime):
+        """
+        Returns a tuple (session URI, offset, requests sent) to continue a checkpointed
+        upload. The session URI is None when a new session must be started.
+        """
+        checkpoint = self.checkpoints.get(file_name)
+        if checkpoint is None:
+            return (None, 0, 0)
+        if checkpoint['size'] != size or checkpoint['mtime'] != mtime:
+            self.logger.info("Local file `%s` changed, restarting the upload", file_name)
+            return (None, 0, 0)
+
+        try:
+            (offset, _) = self._query_offset(checkpoint['session_uri'], size)
+        except (SessionExpiredError, requests.RequestException):
+            self.logger.info("Upload session of `%s` is no longer valid, restarting the upload", file_name)
+            return (None, 0, 1)
+
+        self.logger.info("Resuming upload of `%s` at byte %d of %d", file_name, offset, size)
+        return (checkpoint['session_uri'], offset, 1)
+
+    def _send_chunk(self, session_uri, file_stream, offset, size):
+        """
+        Sends the chunk at offset. Returns a tuple (committed offset, whether the
+        upload is complete).
+        """
+        file_stream.seek(offset)
+        data = file_stream.read(self.chunk_size)
+        if data:
+            content_range = 'bytes %d-%d/%d' % (offset, offset + len(data) - 1, size)
+        else:
+            content_range = 'bytes */%d' % size
+        response = self._session().put(session_uri, data=data, headers={'Content-Range': content_range},
+                                       timeout=self.TIMEOUT)
+        return self._parse_response(response, size)
+
+    def _query_offset(self, session_uri, size):
+        response = self._session().put(session_uri, headers={'Content-Range': 'bytes */%d' % size},
+                                       timeout=self.TIMEOUT)
+        return self._parse_response(response, size)
+
+    def _session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def _parse_response(self, response, size):
+        if response.status_code in (200, 201):
+            return (size, True)
+        if response.status_code == 308:
+            # Range holds the bytes committed so far, absent when nothing was.
+            committed = self.RANGE_PATTERN.match(response.headers.get('Range', ''))
+            return (int(committed.group(1)) + 1 if committed else 0, False)
+        if response.status_code in (404, 410):
+            raise SessionExpiredError("Upload session ended with status %d" % response.status_code)
+        response.raise_for_status()
+        raise requests.HTTPError("Unexpected status %d" % response.status_code, response=response)
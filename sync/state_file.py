@@ -0,0 +1,67 @@
+import json
+import os
+import threading
+import time
+
+class StateFile:
+    """
+    Base class for sync state which is kept as JSON on disk between runs.
+
+    Subclasses keep their data in `self.entries` and set `self.dirty` whenever it
+    changes, while holding `self.lock`. Bump VERSION when the format of the entries
+    changes, older files are discarded.
+    """
+    VERSION = 1
+
+    def __init__(self, logger, state_path, autosave_interval=30):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        self.last_save = time.monotonic()
+        self.autosave_interval = autosave_interval
+
+        assert isinstance(state_path, str), 'State path MUST be a string!'
+        self.state_path = state_path
+
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_path, 'r') as state_file:
+                contents = json.load(state_file)
+        except FileNotFoundError:
+            self.logger.info("Starting new state at `%s`", self.state_path)
+            return
+        except ValueError:
+            self.logger.warn("State file `%s` is corrupt, starting over", self.state_path)
+            return
+
+        if contents.get('version') != self.VERSION:
+            self.logger.warn("State file `%s` has an unknown version, starting over", self.state_path)
+            return
+
+        self.entries = contents.get('entries', {})
+        self.logger.info("Loaded %d entries from `%s`", len(self.entries), self.state_path)
+
+    def save(self, force=False):
+        """
+        Writes the state to disk when it changed. Unless forced, this happens
+        at most once every autosave interval.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            if not force and time.monotonic() - self.last_save < self.autosave_interval:
+                return
+
+            contents = json.dumps({'version': self.VERSION, 'entries': self.entries})
+            self.dirty = False
+            self.last_save = time.monotonic()
+
+        # Write next to the state file and swap, a crash never leaves half a file behind.
+        temp_path = self.state_path + '.tmp'
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        with open(temp_path, 'w') as temp_file:
+            temp_file.write(contents)
+        os.replace(temp_path, self.state_path)
@@ -0,0 +1,25 @@
+import pathlib
+import sys
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from compression import Compressor
+from upload_handler import UploadHandler
+
+class VariantNameTest(unittest.TestCase):
+    def test_variants_are_reserved(self):
+        for encoding in Compressor.ENCODINGS:
+            self.assertTrue(UploadHandler.is_reserved_name(Compressor.variant_name('ns/data.json', encoding)))
+
+    def test_variant_names_are_parsed(self):
+        variant_name = Compressor.variant_name('ns/data.json', 'gzip')
+
+        self.assertEqual(Compressor.original_name(variant_name), ('ns/data.json', 'gzip'))
+
+    def test_compressed_files_are_not_variants(self):
+        self.assertIsNone(Compressor.original_name('ns/data.json.gz'))
+        self.assertIsNone(Compressor.original_name('ns/app.js.br'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import logging
+import pathlib
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from event_coalescing import EventCoalescer
+
+class CoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.handler = mock.Mock()
+        self.now = 0
+        patcher = mock.patch('event_coalescing.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_collapses_into_one_action(self):
+        coalescer = EventCoalescer(logging.getLogger('test'), self.handler, quiet_window=1, max_wait=10)
+        file_path = pathlib.Path('a.txt')
+        for _ in range(3):
+            coalescer.queue_file_upload(file_path)
+        self.now = 1
+
+        self.assertEqual(coalescer._take_due_actions(), [(file_path, EventCoalescer.UPLOAD, None)])
+
+    def test_continuous_changes_are_flushed_after_max_wait(self):
+        coalescer = EventCoalescer(logging.getLogger('test'), self.handler, quiet_window=1, max_wait=10)
+        file_path = pathlib.Path('build.log')
+        while self.now < 10:
+            coalescer.queue_file_upload(file_path)
+            self.assertEqual(coalescer._take_due_actions(), [])
+            self.now += 0.5
+
+        self.assertEqual(coalescer._take_due_actions(), [(file_path, EventCoalescer.UPLOAD, None)])
+
+    def test_replaced_move_removes_its_source(self):
+        coalescer = EventCoalescer(logging.getLogger('test'), self.handler, quiet_window=1, max_wait=10)
+        (a, b, c) = (pathlib.Path('a'), pathlib.Path('b'), pathlib.Path('c'))
+        coalescer.move_file(a, b)
+        coalescer.move_file(c, b)
+        self.now = 1
+
+        self.assertEqual(sorted(coalescer._take_due_actions()), sorted([
+            (b, EventCoalescer.MOVE, c),
+            (a, EventCoalescer.REMOVE, None),
+        ]))
+
+class FlushTest(unittest.TestCase):
+    def test_removals_are_batched_per_directory(self):
+        handler = mock.Mock()
+        coalescer = EventCoalescer(logging.getLogger('test'), handler, quiet_window=60, max_wait=60)
+        files = [pathlib.Path('site/img/%d.png' % index) for index in range(3)]
+        for file_path in files:
+            coalescer.remove_file(file_path)
+        coalescer.remove_file(pathlib.Path('site/index.html'))
+        coalescer.remove_directory(pathlib.Path('site'))
+
+        coalescer.start()
+        coalescer.stop()
+
+        handler.remove_files.assert_called_once_with(files)
+        handler.remove_file.assert_called_once_with(pathlib.Path('site/index.html'))
+        handler.remove_directory.assert_called_once_with(pathlib.Path('site'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import base64
+import hashlib
+import logging
+import pathlib
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from compression import Compressor
+from reconciliation import Reconciler
+
+class CompressedFileTest(unittest.TestCase):
+    def setUp(self):
+        self.watch_path = pathlib.Path(tempfile.mkdtemp()).resolve()
+        self.handler = mock.MagicMock(namespace='ns', watchdir_path=self.watch_path, manifest=None, BATCH_SIZE=100)
+        self.reconciler = Reconciler(logging.getLogger('test'), self.handler)
+
+    def local_file(self, name, content):
+        file_path = self.watch_path / name
+        file_path.write_bytes(content)
+        return file_path
+
+    def remote_blob(self, content):
+        md5_hash = base64.b64encode(hashlib.md5(content).digest()).decode()
+        return types.SimpleNamespace(size=len(content), md5_hash=md5_hash, crc32c=None)
+
+    def test_real_compressed_file_is_not_a_variant(self):
+        local_files = {
+            'ns/data.json': self.local_file('data.json', b'{}'),
+            'ns/data.json.gz': self.local_file('data.json.gz', b'new archive'),
+        }
+        remote_blobs = {
+            'ns/data.json': self.remote_blob(b'{}'),
+            # Stale, the local archive changed.
+            'ns/data.json.gz': self.remote_blob(b'old archive'),
+            'ns/old.json.gz': self.remote_blob(b'removed archive'),
+        }
+        remote_variants = {Compressor.variant_name('ns/data.json', 'gzip')}
+
+        (uploads, removals, unchanged) = self.reconciler.compute_diff(local_files, remote_blobs, remote_variants)
+
+        self.assertEqual(uploads, ['ns/data.json.gz'])
+        self.assertEqual(removals, ['ns/old.json.gz'])
+        self.assertEqual(unchanged, ['ns/data.json'])
+
+    def test_variants_of_removed_files_are_removed(self):
+        local_files = {'ns/data.json': self.watch_path / 'data.json'}
+        kept = Compressor.variant_name('ns/data.json', 'gzip')
+        orphan = Compressor.variant_name('ns/old.json', 'br')
+
+        self.assertEqual(self.reconciler.remove_orphan_variants(local_files, {kept, orphan}, []), 1)
+        self.handler.bucket.blob.assert_called_once_with(orphan)
+
+if __name__ == '__main__':
+    unittest.main()
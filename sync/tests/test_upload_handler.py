@@ -0,0 +1,98 @@
+import logging
+import pathlib
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import upload_handler
+from upload_handler import UploadHandler
+
+class QueueJobTest(unittest.TestCase):
+    def setUp(self):
+        self.watch_path = pathlib.Path(tempfile.mkdtemp()).resolve()
+        self.handler = self.create_handler(upload_workers=1)
+
+    def create_handler(self, upload_workers):
+        # No cloud connection, the workers are never started.
+        with mock.patch.object(upload_handler, 'storage'):
+            return UploadHandler(logging.getLogger('test'), 'bucket', 'ns', self.watch_path, [],
+                                 upload_workers=upload_workers)
+
+    def queued_jobs(self, file_path):
+        return list(self.handler.upload_queues[self.handler._queue_index(file_path)].queue)
+
+    def test_repeated_upload_is_deduplicated(self):
+        file_path = self.watch_path / 'a.txt'
+        self.handler.queue_file_upload(file_path)
+        self.handler.queue_file_upload(file_path)
+
+        self.assertEqual(self.queued_jobs(file_path), [(UploadHandler.UPLOAD, file_path)])
+
+    def test_upload_after_batch_removal_is_queued(self):
+        file_path = self.watch_path / 'a.txt'
+        self.handler.queue_file_upload(file_path)
+        self.handler.remove_files([file_path])
+        self.handler.queue_file_upload(file_path)
+
+        self.assertEqual(self.queued_jobs(file_path), [
+            (UploadHandler.UPLOAD, file_path),
+            (UploadHandler.REMOVE_BATCH, None, (file_path,)),
+            (UploadHandler.UPLOAD, file_path),
+        ])
+
+    def test_move_onto_itself_is_an_upload(self):
+        file_path = self.watch_path / 'a.txt'
+        self.handler.move_file(file_path, file_path)
+
+        self.assertEqual(self.queued_jobs(file_path), [(UploadHandler.UPLOAD, file_path)])
+
+    def test_move_holds_the_source_queue(self):
+        self.handler = self.create_handler(upload_workers=4)
+        src_path = self.watch_path / 'a.txt'
+        dest_path = next(self.watch_path / ('b%d.txt' % index) for index in range(100)
+                         if self.handler._queue_index(self.watch_path / ('b%d.txt' % index))
+                         != self.handler._queue_index(src_path))
+        self.handler.move_file(src_path, dest_path)
+
+        [(action, file_path, barrier)] = self.queued_jobs(src_path)
+        self.assertEqual((action, file_path), (UploadHandler.HOLD, src_path))
+        self.assertEqual(self.queued_jobs(dest_path), [(UploadHandler.MOVE, dest_path, src_path, barrier)])
+
+class NameTest(unittest.TestCase):
+    def test_reserved_directory_is_never_synced(self):
+        watch_path = pathlib.Path(tempfile.mkdtemp()).resolve()
+        with mock.patch.object(upload_handler, 'storage'):
+            handler = UploadHandler(logging.getLogger('test'), 'bucket', '', watch_path, [])
+
+        self.assertEqual(handler.get_cdn_name_exerpt(watch_path / 'a.txt'), 'a.txt')
+        with self.assertRaises(ValueError):
+            handler.get_cdn_name_exerpt(watch_path / UploadHandler.RESERVED_DIRECTORY / 'a.txt')
+
+class StopTest(unittest.TestCase):
+    def test_jobs_queued_by_jobs_are_processed(self):
+        watch_path = pathlib.Path(tempfile.mkdtemp()).resolve()
+        with mock.patch.object(upload_handler, 'storage'):
+            handler = UploadHandler(logging.getLogger('test'), 'bucket', 'ns', watch_path, [], upload_workers=4)
+        page_path = watch_path / 'index.html'
+        # Referenced files end up on other queues than the page.
+        references = [watch_path / ('img%d.png' % index) for index in range(20)]
+        uploaded = []
+
+        def process_upload(file_path):
+            uploaded.append(file_path)
+            if file_path == page_path:
+                for ref_path in references:
+                    handler.queue_file_upload(ref_path)
+
+        handler._process_upload = process_upload
+        handler.start()
+        handler.queue_file_upload(page_path)
+        handler.stop()
+
+        self.assertEqual(sorted(uploaded), sorted([page_path] + references))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,28 +1,93 @@
+import io
+import os
 import pathlib
 import queue
 import mimetypes
 import html
+import threading
 
 from google.cloud import storage
-from google.cloud.exceptions import GoogleCloudError
+from google.cloud.exceptions import GoogleCloudError, NotFound
 
 from processors.processor import BaseProcessor
+from resumable_upload import ResumableUploader
+from composite_upload import CompositeUploader
+from compression import Compressor
+from metrics import Counters
 
 class CheckableQueue(queue.Queue):
     def __contains__(self, item):
         with self.mutex:
             return item in self.queue
 
+    def last_queued(self, file_path):
+        """
+        Returns the most recently queued job for the given path, None if there is none.
+        A batch removal holding the path counts as a job for it.
+        """
+        with self.mutex:
+            for job in reversed(self.queue):
+                if job is None:
+                    continue
+                if job[1] == file_path or (job[0] == UploadHandler.REMOVE_BATCH and file_path in job[2]):
+                    return job
+            return None
+
 class UploadHandler:
-    def __init__(self, logger, cdn_bucket_name, cdn_namespace, watchdir_path, processors):
+    UPLOAD = 'upload'
+    REMOVE = 'remove'
+    REMOVE_BATCH = 'remove_batch'
+    REMOVE_DIRECTORY = 'remove_directory'
+    MOVE = 'move'
+    # Keeps the worker of a move's source waiting until the move is done.
+    HOLD = 'hold'
+    # The cloud accepts at most this many requests in one batch.
+    BATCH_SIZE = 100
+    # Every uploaded file is readable by everyone
+    PREDEFINED_ACL = 'publicRead'
+    # Above this size the client library starts a resumable session, one extra request.
+    MULTIPART_LIMIT = 8 * 1024 * 1024
+    # Bucket level directory of the objects the sync tool keeps for itself, like the
+    # parts of parallel uploads and compressed variants. No local file is ever stored under it.
+    RESERVED_DIRECTORY = '.cdn-sync'
+
+    def __init__(self, logger, cdn_bucket_name, cdn_namespace, watchdir_path, processors, upload_workers=1,
+                 manifest=None, dependency_graph=None, checkpoints=None,
+                 resumable_threshold=32 * 1024 * 1024, resumable_chunk_size=8 * 1024 * 1024,
+                 composite_threshold=None, composite_part_size=64 * 1024 * 1024, composite_parallelism=8,
+                 cache_control=None, compressor=None):
         self.logger = logger.getChild('Uploader')
         self.client = None
         self.bucket = None
         self.processors = []
-        self.upload_queue = CheckableQueue()
+        self.workers = []
         self.type_guesser = mimetypes.MimeTypes()
+        # Request counts, see stats()
+        self.metrics = Counters()
+        self.cache_control = cache_control
+        # Optional UploadManifest, used to skip uploading unchanged files
+        self.manifest = manifest
+        # Optional DependencyGraph, used to only schedule new or changed references of pages
+        self.dependency_graph = dependency_graph
+        # Uploads files above the threshold in chunks, only when a CheckpointStore is provided
+        self.resumable_uploader = None
+        # Uploads files above the threshold as parallel parts, only when a threshold is provided
+        self.composite_uploader = None
+        # Optional Compressor, used to store precompressed variants of compressible files
+        self.compressor = compressor
+
+        assert isinstance(upload_workers, int) and upload_workers > 0, 'At least one upload worker is required!'
+        # One queue per worker, see _queue_job.
+        self.upload_queues = [CheckableQueue() for _ in range(upload_workers)]
+        # Queues both halves of a move at once, see move_file.
+        self.move_lock = threading.Lock()
+        # Jobs queued and not yet processed, over all queues. Jobs queue further jobs
+        # before they are done, so zero means no more jobs can appear.
+        self.idle = threading.Condition()
+        self.pending_jobs = 0
 
         assert isinstance(cdn_namespace, str), 'Namespace name MUST be a string!'
+        assert not self.is_reserved_name(cdn_namespace), 'The namespace name is reserved!'
         self.namespace = cdn_namespace
 
         assert isinstance(watchdir_path, pathlib.PurePath), 'The watchdir argument is not a PATH object!'
@@ -33,6 +98,12 @@ class UploadHandler:
         # Initialise
         ###################
         self._setup_cloud_bucket(cdn_bucket_name)
+        if checkpoints is not None:
+            self.resumable_uploader = ResumableUploader(self.logger, self.client, checkpoints,
+                                                        resumable_threshold, resumable_chunk_size)
+        if composite_threshold is not None:
+            self.composite_uploader = CompositeUploader(self.logger, self.bucket, composite_threshold,
+                                                        composite_part_size, composite_parallelism)
 
         # Asserts the parameter can be iterated over
         assert hasattr(processors, "__iter__")
@@ -59,55 +130,277 @@ class UploadHandler:
         # Build path with namespace, if provided
         file_name_exerpt = pathlib.Path(self.namespace, file_name_exerpt)
         file_name = file_name_exerpt.as_posix()
+        if self.is_reserved_name(file_name):
+            raise ValueError("`%s` lies within the reserved directory" % file_name)
         return file_name
 
+    @classmethod
+    def is_reserved_name(cls, file_name):
+        return file_name == cls.RESERVED_DIRECTORY or file_name.startswith(cls.RESERVED_DIRECTORY + '/')
+
+    def get_local_path(self, file_name):
+        """
+        Inverse of get_cdn_name_exerpt.
+        """
+        file_name_exerpt = pathlib.PurePosixPath(file_name)
+        if self.namespace:
+            file_name_exerpt = file_name_exerpt.relative_to(self.namespace)
+        return self.watchdir_path.joinpath(*file_name_exerpt.parts)
+
+    def start(self):
+        """
+        Spawns one worker thread per upload queue.
+        """
+        for index, job_queue in enumerate(self.upload_queues):
+            worker = threading.Thread(target=self._work, args=(job_queue,),
+                                      name="UploadWorker-%d" % index, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        self.logger.info("Started %d upload workers", len(self.workers))
+
+    def stop(self):
+        """
+        Lets the workers finish all queued jobs and waits until they exit.
+        """
+        # Jobs keep queueing jobs on other queues, e.g. references of pages. Only once
+        # all of them are done no worker can miss a job for having stopped already.
+        self.join()
+        for job_queue in self.upload_queues:
+            job_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+        self.logger.info("Upload workers stopped")
+
+        for state in (self.manifest, self.dependency_graph):
+            if state is not None:
+                state.save(force=True)
+
+        stats = self.stats()
+        self.logger.info("Uploaded %d files in %d requests, moved %d files in %d requests, removed %d files in %d requests",
+                         stats.get('files_uploaded', 0), stats.get('upload_requests', 0),
+                         stats.get('files_moved', 0), stats.get('move_requests', 0),
+                         stats.get('files_removed', 0), stats.get('remove_requests', 0))
+
+    def stats(self):
+        """
+        Returns the counters of files and requests sent to the cloud.
+        """
+        stats = self.metrics.snapshot()
+        if stats.get('files_uploaded'):
+            stats['requests_per_upload'] = stats['upload_requests'] / stats['files_uploaded']
+        return stats
+
+    def join(self):
+        """
+        Blocks until every queued job has been processed, including the jobs those
+        jobs queued.
+        """
+        with self.idle:
+            while self.pending_jobs:
+                self.idle.wait()
+
     def queue_file_upload(self, file_path):
         if not isinstance(file_path, pathlib.PurePath):
             raise ValueError("Provided parameter is NOT a PATH object")
         if not file_path.exists():
             self.logger.warn("File `%s` doesn't exist!", file_path.as_posix())
-            
-        self.upload_queue.put(file_path)
-        while not self.upload_queue.empty():
-            next_item = self.upload_queue.get()
-            if not next_item.is_file():
-                continue
 
-            # Guess file-type.
-            # (content_type, encoding)
-            type_result = self.type_guesser.guess_type(next_item.as_posix())
-            file_name = None
-
-            with open(next_item.as_posix(), 'rb') as file_stream_orig:
-                file_stream = file_stream_orig
-                # Push filename and stream through each processor
-                for p in self.processors:
-                    (file_stream, file_name, referenced_files) = p.process_file(file_stream, file_path, type_result)
-                    if referenced_files and hasattr(referenced_files, "__iter__"):
-                        for ref_path in referenced_files:
-                            if not isinstance(ref_path, pathlib.PurePath):
-                                self.logger.warn("A returned new file item is NOT a PATH object!")
-                                continue
-                            if ref_path not in self.upload_queue and ref_path != next_item:
-                                self.upload_queue.put(ref_path)
-
-                if not file_name:
-                    try:
-                        # Construct item name relative to the watched path
-                        file_name = self.get_cdn_name_exerpt(next_item)
-                    except ValueError:
-                        self.logger.warn("Found a file `%s` which is not located under the watch directory!", next_item.as_posix())
-
-                # .. and push file to cloud
-                self.logger.info("Uploading `%s` to cloud", next_item.as_posix())
-                (pub_url, result) = self._upload_file(file_stream, file_name, type_result)
-                if result:
-                    self.logger.info("File uploaded at %s", pub_url)
+        self._queue_job(self.UPLOAD, file_path)
 
     def remove_file(self, file_path):
         if not isinstance(file_path, pathlib.PurePath):
             raise ValueError("Provided parameter is NOT a PATH object")
 
+        self._queue_job(self.REMOVE, file_path)
+
+    def move_file(self, src_path, dest_path):
+        """
+        Moves the object of src_path to dest_path within the cloud, without uploading.
+        """
+        if not isinstance(src_path, pathlib.PurePath) or not isinstance(dest_path, pathlib.PurePath):
+            raise ValueError("Provided parameter is NOT a PATH object")
+
+        if src_path == dest_path:
+            self._queue_job(self.UPLOAD, dest_path)
+            return
+
+        # Queued for the destination, later changes to it can never be overwritten by the move.
+        src_queue = self.upload_queues[self._queue_index(src_path)]
+        dest_queue = self.upload_queues[self._queue_index(dest_path)]
+        if src_queue is dest_queue:
+            self._put(dest_queue, (self.MOVE, dest_path, src_path, None))
+            return
+
+        # The move deletes the source, the worker of the source holds its later jobs
+        # until the move is done. Queued together, so holds never wait on each other.
+        barrier = (threading.Event(), threading.Event())
+        with self.move_lock:
+            self._put(src_queue, (self.HOLD, src_path, barrier))
+            self._put(dest_queue, (self.MOVE, dest_path, src_path, barrier))
+
+    def remove_files(self, file_paths):
+        """
+        Removes multiple files, grouping the deletions into batch requests.
+        """
+        batches = {}
+        for file_path in file_paths:
+            if not isinstance(file_path, pathlib.PurePath):
+                raise ValueError("Provided parameter is NOT a PATH object")
+            batches.setdefault(self._queue_index(file_path), []).append(file_path)
+
+        for (index, batch) in batches.items():
+            # Every batch only holds paths of one queue, which keeps them in order
+            # with the other jobs for those paths.
+            self._put(self.upload_queues[index], (self.REMOVE_BATCH, None, tuple(batch)))
+
+    def remove_directory(self, dir_path):
+        """
+        Removes all files the cloud holds under the directory.
+        """
+        if not isinstance(dir_path, pathlib.PurePath):
+            raise ValueError("Provided parameter is NOT a PATH object")
+
+        self._queue_job(self.REMOVE_DIRECTORY, dir_path)
+
+    def _queue_index(self, file_path):
+        return hash(file_path) % len(self.upload_queues)
+
+    def _queue_job(self, action, file_path, *arguments):
+        # All jobs for one path end up on the same worker, which processes them
+        # in order. A removal can never overtake an upload of the same object.
+        job = (action, file_path) + arguments
+        job_queue = self.upload_queues[self._queue_index(file_path)]
+        if job_queue.last_queued(file_path) == job:
+            # The same job is still waiting, no need to do the work twice.
+            return
+
+        self._put(job_queue, job)
+
+    def _put(self, job_queue, job):
+        with self.idle:
+            self.pending_jobs += 1
+        job_queue.put(job)
+
+    def _job_done(self):
+        with self.idle:
+            self.pending_jobs -= 1
+            if not self.pending_jobs:
+                self.idle.notify_all()
+
+    def _work(self, job_queue):
+        while True:
+            job = job_queue.get()
+            try:
+                if job is None:
+                    return
+
+                (action, file_path) = job[:2]
+                if action == self.UPLOAD:
+                    self._process_upload(file_path)
+                elif action == self.REMOVE:
+                    self._process_removal(file_path)
+                elif action == self.REMOVE_BATCH:
+                    self._process_batch_removal(job[2])
+                elif action == self.REMOVE_DIRECTORY:
+                    self._process_directory_removal(file_path)
+                elif action == self.MOVE:
+                    self._process_barrier_move(job[2], file_path, job[3])
+                elif action == self.HOLD:
+                    (reached, done) = job[2]
+                    reached.set()
+                    done.wait()
+            except Exception as error:
+                self.logger.exception(error)
+            finally:
+                job_queue.task_done()
+                if job is not None:
+                    self._job_done()
+
+            for state in (self.manifest, self.dependency_graph):
+                if state is not None:
+                    state.save()
+
+    def _process_upload(self, file_path):
+        if not file_path.is_file():
+            return
+
+        # Guess file-type.
+        # (content_type, encoding)
+        type_result = self.type_guesser.guess_type(file_path.as_posix())
+        file_name = None
+        fingerprint = None
+        # None unless a processor looked for referenced files
+        references = None
+
+        with open(file_path.as_posix(), 'rb') as file_stream_orig:
+            file_stream = file_stream_orig
+            # Push filename and stream through each processor
+            for p in self.processors:
+                (file_stream, file_name, referenced_files) = p.process_file(file_stream, file_path, type_result)
+                if referenced_files is not None and hasattr(referenced_files, "__iter__"):
+                    references = references or []
+                    for ref_path in referenced_files:
+                        if not isinstance(ref_path, pathlib.PurePath):
+                            self.logger.warn("A returned new file item is NOT a PATH object!")
+                            continue
+                        if ref_path != file_path:
+                            references.append(ref_path)
+
+            if not file_name:
+                try:
+                    # Construct item name relative to the watched path
+                    file_name = self.get_cdn_name_exerpt(file_path)
+                except ValueError:
+                    self.logger.warn("Found a file `%s` which is not located under the watch directory!", file_path.as_posix())
+                    return
+
+            if references is not None:
+                self._schedule_references(file_name, references)
+            elif self.dependency_graph is not None:
+                pages = self.dependency_graph.dependents(file_name)
+                if pages:
+                    self.logger.debug("`%s` is referenced by %s", file_name, ", ".join(pages))
+
+            if self.manifest is not None:
+                fingerprint = self.manifest.fingerprint(file_name, file_path)
+                if self.manifest.is_current(file_name, fingerprint):
+                    self.logger.info("Skipping `%s`, the cloud holds the same contents", file_path.as_posix())
+                    return
+
+            # .. and push file to cloud
+            self.logger.info("Uploading `%s` to cloud", file_path.as_posix())
+            (pub_url, blob) = self._upload_file(file_stream, file_name, type_result, file_path)
+            if blob is not None:
+                self.logger.info("File uploaded at %s", pub_url)
+                if self.manifest is not None:
+                    encodings = self._stored_encodings(blob)
+                    stale = set(self.manifest.encodings(file_name)) - set(encodings)
+                    self.manifest.record_upload(file_name, fingerprint, blob.md5_hash, blob.crc32c, encodings)
+                    # No longer listed by the file, the app won't serve them anymore.
+                    self._remove_variants(file_name, stale)
+
+    def _schedule_references(self, page_name, referenced_files):
+        references = {}
+        for ref_path in referenced_files:
+            try:
+                references[self.get_cdn_name_exerpt(ref_path)] = ref_path
+            except ValueError:
+                self.logger.warn("Found a file `%s` which is not located under the watch directory!", ref_path.as_posix())
+
+        if self.dependency_graph is None:
+            scheduled = list(references.values())
+        else:
+            scheduled = self.dependency_graph.update_page(page_name, references)
+            self.logger.debug("Page `%s` has %d references, %d new or changed",
+                              page_name, len(references), len(scheduled))
+
+        for ref_path in scheduled:
+            self.queue_file_upload(ref_path)
+
+    def _process_removal(self, file_path):
         # Guess file-type.
         # (content_type, encoding)
         # type_result = self.type_guesser.guess_type(file_path.as_posix())
@@ -122,20 +415,177 @@ class UploadHandler:
                 file_name = self.get_cdn_name_exerpt(file_path)
             except ValueError:
                 self.logger.warn("Found a file `%s` which is not located under the watch directory!", file_path.as_posix())
+                return
 
         self._remove_file(file_name)
+
+    def _process_barrier_move(self, src_path, dest_path, barrier):
+        if barrier is None:
+            self._process_move(src_path, dest_path)
+            return
+
+        (reached, done) = barrier
+        # Every earlier job for the source is done once its worker reaches the hold.
+        reached.wait()
+        try:
+            self._process_move(src_path, dest_path)
+        finally:
+            done.set()
+
+    def _process_move(self, src_path, dest_path):
+        try:
+            src_name = self.get_cdn_name_exerpt(src_path)
+            dest_name = self.get_cdn_name_exerpt(dest_path)
+        except ValueError:
+            # Moved into or out of the watch directory
+            self.logger.warn("Move from `%s` to `%s` crosses the watch directory!", src_path.as_posix(), dest_path.as_posix())
+            self._process_removal(src_path)
+            self._process_upload(dest_path)
+            return
+
+        if src_name == dest_name:
+            # Copying an object onto itself and deleting it would lose it.
+            self._process_upload(dest_path)
+            return
+
+        if self.type_guesser.guess_type(src_path.as_posix()) != self.type_guesser.guess_type(dest_path.as_posix()):
+            # A copy keeps the content type and variants of the source, the destination
+            # needs its own.
+            self.logger.info("Move from `%s` to `%s` changes the content type, uploading instead", src_name, dest_name)
+            self._process_removal(src_path)
+            self._process_upload(dest_path)
+            return
+
+        encodings = self.manifest.encodings(src_name) if self.manifest is not None else []
+        for encoding in encodings:
+            # Variants first, the file lists them for the app.
+            try:
+                self._move_object(Compressor.variant_name(src_name, encoding),
+                                  Compressor.variant_name(dest_name, encoding))
+            except NotFound:
+                self.logger.warn("The %s variant of `%s` wasn't found online", encoding, src_name)
+
+        try:
+            self._move_object(src_name, dest_name)
+        except NotFound:
+            self.logger.info("`%s` isn't online, uploading `%s` instead", src_name, dest_path.as_posix())
+            self._process_upload(dest_path)
+            return
+
+        self.metrics.increment('files_moved')
+        self.logger.info("Moved `%s` to `%s` in cloud", src_name, dest_name)
+        if self.dependency_graph is not None:
+            self.dependency_graph.remove_page(src_name)
+        if self.manifest is not None:
+            self.manifest.rename(src_name, dest_name)
+            # Skips the upload unless the file changed before the move, but still
+            # schedules the references of a page, relative links may point elsewhere now.
+            self._process_upload(dest_path)
+
+    def _move_object(self, src_name, dest_name):
+        src_blob = storage.Blob(src_name, self.bucket)
+        self.metrics.increment('move_requests')
+        dest_blob = self.bucket.copy_blob(src_blob, self.bucket, dest_name)
+
+        try:
+            # A copy gets the default ACL of the bucket.
+            self.metrics.increment('move_requests', 2)
+            dest_blob.make_public()
+            src_blob.delete()
+        except NotFound:
+            pass
+
+    def _process_batch_removal(self, file_paths):
+        file_names = []
+        for file_path in file_paths:
+            try:
+                file_name = self.get_cdn_name_exerpt(file_path)
+            except ValueError:
+                self.logger.warn("Found a file `%s` which is not located under the watch directory!", file_path.as_posix())
+                continue
+            file_names.append(file_name)
+            if self.manifest is not None:
+                file_names.extend(Compressor.variant_name(file_name, encoding)
+                                  for encoding in self.manifest.encodings(file_name))
+        # A directory listing already holds the variants, each object is deleted once.
+        file_names = list(dict.fromkeys(file_names))
+
+        for start in range(0, len(file_names), self.BATCH_SIZE):
+            batch_names = file_names[start:start + self.BATCH_SIZE]
+            try:
+                self.metrics.increment('remove_requests')
+                with self.client.batch():
+                    for file_name in batch_names:
+                        storage.Blob(file_name, self.bucket).delete()
+                self.logger.info("Removed %d files from cloud", len(batch_names))
+            except GoogleCloudError as error:
+                # Every deletion in the batch was attempted, the error is about the first failure.
+                self.logger.error("Not all of %d files were removed from cloud: %s", len(batch_names), error)
+
+            self.metrics.increment('files_removed', len(batch_names))
+            for file_name in batch_names:
+                self._forget(file_name)
+
+    def _process_directory_removal(self, dir_path):
+        try:
+            prefix = self.get_cdn_name_exerpt(dir_path) + '/'
+        except ValueError:
+            self.logger.warn("Found a directory `%s` which is not located under the watch directory!", dir_path.as_posix())
+            return
+
+        file_paths = []
+        for blob in self.bucket.list_blobs(prefix=prefix, fields='items(name),nextPageToken'):
+            file_path = self.get_local_path(blob.name)
+            if file_path.exists():
+                # Recreated after the directory was removed, must stay online.
+                continue
+            file_paths.append(file_path)
+
+        self.logger.info("Removing %d files under `%s` from cloud", len(file_paths), prefix)
+        self.remove_files(file_paths)
         
     def _remove_file(self, file_name):
+        if self.manifest is not None:
+            self._remove_variants(file_name, self.manifest.encodings(file_name))
+
         blob = storage.Blob(file_name, self.bucket)
         try:
+            self.metrics.increment('remove_requests')
             blob.delete()
-            blob.patch()
+            self.metrics.increment('files_removed')
             self.logger.info("Removed `%s` from cloud", file_name)
         except GoogleCloudError:
             self.logger.error("The file `%s` wasn't found online", file_name)
 
+        self._forget(file_name)
 
-    def _upload_file(self, file_stream, file_name, type_result):
+    def _remove_variants(self, file_name, encodings):
+        for encoding in encodings:
+            variant_name = Compressor.variant_name(file_name, encoding)
+            try:
+                self.metrics.increment('remove_requests')
+                storage.Blob(variant_name, self.bucket).delete()
+                self.logger.info("Removed `%s` from cloud", variant_name)
+            except GoogleCloudError:
+                self.logger.error("The file `%s` wasn't found online", variant_name)
+
+    def _forget(self, file_name):
+        if self.manifest is not None:
+            self.manifest.forget(file_name)
+        if self.dependency_graph is not None:
+            self.dependency_graph.remove_page(file_name)
+
+
+    def _use_composite_upload(self, file_stream, file_path, file_size):
+        if self.composite_uploader is None:
+            return False
+        if file_size < self.composite_uploader.threshold or file_size <= self.composite_uploader.part_size:
+            return False
+        # Parts are read straight from disk, which is only valid when no processor
+        # replaced the original file stream.
+        return getattr(file_stream, 'name', None) == file_path.as_posix()
+
+    def _upload_file(self, file_stream, file_name, type_result, file_path):
         try:
             # Build new blob object
             blob = storage.Blob(file_name, self.bucket)            
@@ -144,23 +594,70 @@ class UploadHandler:
             # Because of a lack of object versioning policies
             # the blob data will overwrite previous data for existing
             # blobs with the same filename.
-            blob.upload_from_file(file_stream)
-            
+            file_stream.seek(0, os.SEEK_END)
+            file_size = file_stream.tell()
+            file_stream.seek(0)
+
             # Decompile content type etc.
             (content_type, encoding) = type_result
             # Configure file.
+            # The metadata and ACL travel along with the data, no extra requests needed.
             if content_type:
                 blob.content_type = content_type
             if encoding:
                 blob.content_encoding = encoding
-            blob.make_public()
-            # Commit changes to the cloud.
-            blob.patch()
+            if self.cache_control:
+                blob.cache_control = self.cache_control
+
+            variants = {}
+            if self.compressor is not None:
+                variants = self.compressor.compress(file_stream, file_size, type_result)
+            request_count = self._upload_variants(file_name, variants, content_type)
+            if variants:
+                # The app only serves the variants listed here, all of them are online by now.
+                blob.metadata = {'encodings': ','.join(sorted(variants))}
+
+            if self._use_composite_upload(file_stream, file_path, file_size):
+                request_count += self.composite_uploader.upload(blob, file_path, file_size)
+                # Composing cannot set an ACL.
+                blob.make_public()
+                request_count += 1
+            elif self.resumable_uploader is not None and file_size >= self.resumable_uploader.threshold:
+                request_count += self.resumable_uploader.upload(blob, file_stream, file_name, file_path,
+                                                                predefined_acl=self.PREDEFINED_ACL)
+            else:
+                blob.upload_from_file(file_stream, size=file_size, content_type=content_type,
+                                      predefined_acl=self.PREDEFINED_ACL)
+                request_count += 1 if file_size <= self.MULTIPART_LIMIT else 2
+
+            self.metrics.increment('files_uploaded')
+            self.metrics.increment('upload_requests', request_count)
+            self.logger.debug("Uploaded `%s` in %d requests", file_name, request_count)
 
             # Get resource url, which is a Unicode string.
             url = html.unescape(blob.public_url)
-            return (url, True)
+            return (url, blob)
         except GoogleCloudError as error:
             self.logger.exception(error)
-            return ("", False)
+            return ("", None)
     
+
+    def _upload_variants(self, file_name, variants, content_type):
+        """
+        Uploads the compressed variants of a file. Returns the amount of requests sent.
+        """
+        request_count = 0
+        for (encoding, compressed) in variants.items():
+            variant = storage.Blob(Compressor.variant_name(file_name, encoding), self.bucket)
+            variant.content_encoding = encoding
+            # no-transform keeps the cloud from decompressing the variant on the fly.
+            variant.cache_control = ', '.join(filter(None, [self.cache_control, 'no-transform']))
+            variant.upload_from_file(io.BytesIO(compressed), size=len(compressed), content_type=content_type,
+                                     predefined_acl=self.PREDEFINED_ACL)
+            request_count += 1 if len(compressed) <= self.MULTIPART_LIMIT else 2
+        return request_count
+
+    @staticmethod
+    def _stored_encodings(blob):
+        encodings = (blob.metadata or {}).get('encodings')
+        return encodings.split(',') if encodings else []
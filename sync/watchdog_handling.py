@@ -8,6 +8,10 @@ class FSEventHandler(FileSystemEventHandler):
     """
     Object responding to events coming from the observer as a 
     consequence of a filesystem change.
+
+    upload_handler: receives the changes through queue_file_upload, remove_file,
+    remove_directory and move_file, this is either the UploadHandler or an
+    EventCoalescer in front of it.
     """
     def __init__(self, logger, watched_path, upload_handler):
         self.logging = logger.getChild('Watcher')
@@ -30,8 +34,7 @@ class FSEventHandler(FileSystemEventHandler):
         self.logging.info("Moved %s: from %s to %s", what, src_path.as_posix(), dest_path.as_posix())
 
         if what == 'file':
-            self.handler.remove_file(src_path)
-            self.handler.queue_file_upload(dest_path)
+            self.handler.move_file(src_path, dest_path)
         else:
             self.move_recursive(src_path, dest_path)
 
@@ -80,16 +83,12 @@ class FSEventHandler(FileSystemEventHandler):
             self.handler.queue_file_upload(src_path)
 
     def remove_recursive(self, dir_path):
-        for root, dirs, files in os.walk(dir_path.as_posix()):
-            for name in files:
-                self.handler.remove_file(dir_path.joinpath(name))
-            for dir_name in dirs:
-                self.remove_recursive(dir_path.joinpath(dir_name))
+        # The directory is already gone locally, the cloud knows which files it held.
+        self.handler.remove_directory(dir_path)
     
     def move_recursive(self, src_path, target_path):
-        for root, dirs, files in os.walk(src_path.as_posix()):
+        # The source directory is gone, its files now live under the target.
+        for root, dirs, files in os.walk(target_path.as_posix()):
             for name in files:
-                self.handler.remove_file(src_path.joinpath(name))
-                self.handler.queue_file_upload(target_path.joinpath(name))
-            for dir_name in dirs:
-                self.move_recursive(src_path.joinpath(dir_name), target_path.joinpath(dir_name))
\ No newline at end of file
+                file_path = pathlib.Path(root, name)
+                self.handler.move_file(src_path.joinpath(file_path.relative_to(target_path)), file_path)
\ No newline at end of file